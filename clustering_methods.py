@@ -51,19 +51,17 @@ def knnGraph(similarity_matrix, k):
     
 def create_knn_graph(similarity_matrix, k):
     """ Returns a knn graph from a similarity matrix - NetworkX module """
+    from manager import knn_indices # imported here, manager is heavy to load
     np.fill_diagonal(similarity_matrix, 0) # for removing the 1 from diagonal
     g = nx.Graph()
     g.add_nodes_from(range(len(similarity_matrix)))
-    for idx in range(len(similarity_matrix)):
-        g.add_edges_from([(idx, i) for i in nearest_neighbors(similarity_matrix, idx, k)])
+    indices = knn_indices(similarity_matrix, k)[0]
+    g.add_edges_from((idx, int(i)) for idx in range(len(similarity_matrix)) for i in indices[idx])
     return g  
     
 def nearest_neighbors(similarity_matrix, idx, k):
-    distances = []
-    for x in range(len(similarity_matrix)):
-        distances.append((x,similarity_matrix[idx][x]))
-    distances.sort(key=operator.itemgetter(1), reverse=True)
-    return [d[0] for d in distances[0:k]]    
+    from manager import knn_indices
+    return knn_indices(similarity_matrix[idx:idx+1], k)[0][0].tolist()
  
 #X, y = make_blobs(n_samples=10, centers=10, n_features=2, random_state=0)
 #similarity = euclidean_distances(X)
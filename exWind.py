@@ -5,6 +5,7 @@ from sklearn.preprocessing import scale
 from hmm.continuous.GMHMM import GMHMM
 from hmm.discrete.DiscreteHMM import DiscreteHMM
 import numpy
+from manager import RaggedFrames
 
 means = []
 vars = []
@@ -18,14 +19,16 @@ d = 12
 
 
 
-for analysis in b.analysis.lowlevel.mfcc:
-    if analysis is not None:
+# remove the first mfcc coefficient and scale the frames of each sound (vectorised on all the sounds)
+mfcc = b.analysis.lowlevel.mfcc
+if not isinstance(mfcc, RaggedFrames):
+    mfcc = RaggedFrames.from_list(mfcc)
+mfcc = RaggedFrames(mfcc.values[:, 1:], mfcc.offsets, mfcc.mask).standardize()
+
+for obs in mfcc:
+    if obs is not None:
         try:
-            obs = numpy.array(analysis)
-            obs = obs.T
-            obs = obs[1:]
-            obs = obs.T
-            obs = scale(obs)
+            obs = numpy.asarray(obs, dtype=numpy.double)
 
             model = GaussianHMM(algorithm='viterbi', covariance_type='diag', covars_prior=0.01,
                   covars_weight=1, init_params='mc', means_prior=0, means_weight=0,
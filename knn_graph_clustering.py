@@ -163,7 +163,7 @@ class Cluster:
         if features == None:
             print 'You must provide the text features as argument or run extract_text_features() first'
         else:
-            self.text_similarity_matrix = cosine_similarity(features)
+            self.text_similarity_matrix = cosine_similarity(manager.as_features(features))
         
 #    def extract_acoustic_features(self, basket=None):
 #        """ Extract acoustic features """
@@ -203,7 +203,7 @@ class Cluster:
         if features == None:
             print 'You must provide the acoustic features as argument or run extract_acoustic_features() first'
         else:
-            matrix = euclidean_distances(features)
+            matrix = euclidean_distances(manager.as_features(features))
             matrix = matrix/matrix.max()
             self.acoustic_similarity_matrix = 1 - matrix
             
@@ -233,11 +233,7 @@ class Cluster:
         
     @staticmethod
     def nearest_neighbors(similarity_matrix, idx, k):
-        distances = []
-        for x in range(len(similarity_matrix)):
-            distances.append((x,similarity_matrix[idx][x]))
-        distances.sort(key=operator.itemgetter(1), reverse=True)
-        return [d[0] for d in distances[0:k]]
+        return manager.knn_indices(similarity_matrix[idx:idx+1], k)[0][0].tolist()
     
     def create_knn_graph(self, similarity_matrix, k):
         """ Returns a knn graph from a similarity matrix - NetworkX module """
@@ -245,10 +241,11 @@ class Cluster:
         np.fill_diagonal(similarity_matrix, 0) # for removing the 1 from diagonal
         g = nx.Graph()
         g.add_nodes_from(range(len(similarity_matrix)))
+        indices, scores = manager.knn_indices(similarity_matrix, k)
         for idx in range(len(similarity_matrix)):
             #g.add_edges_from([(idx, i) for i in self.nearest_neighbors(similarity_matrix, idx, k) if similarity_matrix[idx][i] > threshold])
             #g.add_weighted_edges_from([(idx, i[0], i[1]) for i in zip(range(len(similarity_matrix)), similarity_matrix[idx]) if                 i[0] != idx and i[1] > threshold])
-            g.add_weighted_edges_from([(idx, i, similarity_matrix[idx][i]) for i in self.nearest_neighbors(similarity_matrix, idx, k) if similarity_matrix[idx][i] > threshold])
+            g.add_weighted_edges_from([(idx, int(i), s) for i, s in zip(indices[idx], scores[idx]) if s > threshold])
             
             #print idx, self.nearest_neighbors(similarity_matrix, idx, k)
         return g
@@ -8,6 +8,12 @@ This lib provides method for managing files and data with a local data storage
 import sys
 sys.path.append('/home/xavier/Documents/dev/freesound-python/')
 import copy
+from collections import defaultdict
+import warnings
+import multiprocessing
+import inspect
+import tempfile
+import shutil
 import freesound
 import os
 import json
@@ -33,6 +39,7 @@ from scipy import spatial
 import scipy
 from sklearn.metrics.pairwise import cosine_similarity
 import re
+from fnmatch import fnmatch
 from nltk.stem.porter import PorterStemmer
 from sklearn.feature_extraction.text import CountVectorizer
 from stop_words import get_stop_words
@@ -45,6 +52,13 @@ import networkx as nx
 from sklearn.decomposition import LatentDirichletAllocation
 
 LENGTH_BAR = 30 # length of the progress bar
+ANALYSIS_TEMPLATE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'analysis_template.json')
+PARALLEL_MIN_FILES = 200 # under this number of local files, the analysis json are parsed in the main process
+PARALLEL_MIN_SOUNDS = 5000 # under this number of sounds, the text preprocessing is done in the main process
+KNN_TABLE = 'nearest_knn' # nearest neighbours table written by Nlp.compute_knn_similarities and read by the graph methods
+FRAMEWISE_DESCRIPTORS = ('lowlevel.*', 'tonal.hpcp', 'tonal.hpcp_entropy', 'tonal.hpcp_crest', 'tonal.chords_strength',
+                         'rhythm.beats_loudness', 'rhythm.beats_loudness_band_ratio',
+                         'sfx.inharmonicity', 'sfx.oddtoevenharmonicenergyratio', 'sfx.tristimulus') # descriptors aggregated in the stats
 
 
 class SettingsSingleton(object):
@@ -57,7 +71,10 @@ class SettingsSingleton(object):
             self.local_analysis = []
             self.local_baskets = []
             self.local_baskets_pickle = []
+            self.local_baskets_store = []
             self.autoSave = True
+            self.frames_dtype = 'float32' # dtype of the loaded analysis frames, 'float16' halves their memory
+            self.features_dtype = 'float32' # dtype of the descriptor stats matrices and similarity computations
     instance = None
     def __new__(cls): # __new__ always a classmethod
         if not SettingsSingleton.instance:
@@ -117,6 +134,10 @@ class Client(freesound.FreesoundClient):
     def local_baskets_pickle(self):
         return self._local_('local_baskets_pickle')
 
+    @property
+    def local_baskets_store(self):
+        return self._local_('local_baskets_store')
+
     #________________________________________________________________________#
     # __________________________ Users functions ____________________________#
     def my_text_search(self, **param):
@@ -234,7 +255,185 @@ class Client(freesound.FreesoundClient):
 				analysis = getattr(analysis, desc)
 		return analysis
 
-	
+    def my_get_analysis_parallel(self, idsToLoad, descriptor, processes=None, chunk_size=50, Bar=None):
+        """
+        Returns the RaggedFrames of the frames of a descriptor for many sounds.
+        The locally cached analysis json files are parsed in a pool of processes (one per core by default),
+        each worker writes the frames of its chunk of files in a numpy buffer on a temporary memory file system,
+        which is memory mapped back here instead of sending the frames as pickled lists.
+        The analysis that are not in local are requested to Freesound with my_get_analysis()
+
+        >>> frames = c.my_get_analysis_parallel(b.ids, 'lowlevel.mfcc')
+        """
+        settings = SettingsSingleton()
+        local_analysis = set(settings.local_analysis)
+        lengths = np.zeros(len(idsToLoad), dtype=np.int64)
+        mask = np.zeros(len(idsToLoad), dtype=bool)
+        remote = {}
+        local = []
+        for i, idToLoad in enumerate(idsToLoad):
+            if idToLoad in local_analysis:
+                local.append(i)
+            elif idToLoad is not None:
+                frames = self.my_get_analysis(idToLoad, descriptor)
+                if frames is not None:
+                    remote[i] = frames
+        shm = '/dev/shm' if os.path.isdir('/dev/shm') else None
+        tmp_path = tempfile.mkdtemp(dir=shm)
+        try:
+            chunks = [local[start:start + chunk_size] for start in range(0, len(local), chunk_size)]
+            tasks = [([idsToLoad[i] for i in chunk], descriptor, settings.frames_dtype, os.path.join(tmp_path, str(k) + '.npy'))
+                     for k, chunk in enumerate(chunks)]
+            buffers = []
+            ndims = []
+            for chunk, (chunk_lengths, ndim, out_path) in zip(chunks, self._parallel_map(_parse_frames_files, tasks, processes, len(local), Bar)):
+                chunk, chunk_lengths = np.array(chunk, dtype=np.int64), np.array(chunk_lengths, dtype=np.int64)
+                found = chunk_lengths >= 0
+                lengths[chunk[found]] = chunk_lengths[found]
+                mask[chunk[found]] = True
+                if ndim is not None:
+                    ndims.append(ndim)
+                buffer = np.load(out_path, mmap_mode='r')
+                if len(buffer):
+                    buffers.append(buffer)
+            if len(set(buffer.shape[1] for buffer in buffers)) > 1:
+                raise ValueError('the frames do not have the same dimension for all sounds')
+            # the buffers of the chunks are copied once, in the order of the sounds
+            values = np.concatenate(buffers) if buffers else np.zeros((0, 1), dtype=settings.frames_dtype)
+        finally:
+            shutil.rmtree(tmp_path)
+        offsets = np.zeros(len(idsToLoad) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=offsets[1:])
+        all_frames = RaggedFrames(values, offsets, mask, max(ndims) if ndims else 1)
+        if remote:
+            # the frames requested to Freesound are appended, then moved to the positions of their sounds
+            positions = sorted(remote)
+            all_frames.extend(RaggedFrames.from_list([remote[i] for i in positions]))
+            order = np.arange(len(idsToLoad))
+            order[positions] = len(idsToLoad) + np.arange(len(positions))
+            all_frames = all_frames.take(order)
+        return all_frames
+
+    def my_get_analysis_stats_parallel(self, idsToLoad, processes=None, chunk_size=50, Bar=None):
+        """
+        Returns the list of the analysis stats of many sounds (None for missing ones).
+        The locally cached json files are parsed in a pool of processes (see my_get_analysis_parallel),
+        the others are requested to Freesound with my_get_analysis_stats()
+        """
+        local_analysis_stats = set(SettingsSingleton().local_analysis_stats)
+        all_stats = [None] * len(idsToLoad)
+        local = []
+        for i, idToLoad in enumerate(idsToLoad):
+            if idToLoad in local_analysis_stats:
+                local.append(i)
+            elif idToLoad is not None:
+                all_stats[i] = self.my_get_analysis_stats(idToLoad)
+        chunks = [local[start:start + chunk_size] for start in range(0, len(local), chunk_size)]
+        tasks = [[idsToLoad[i] for i in chunk] for chunk in chunks]
+        for chunk, results in zip(chunks, self._parallel_map(_parse_stats_files, tasks, processes, len(local), Bar)):
+            for i, analysis in zip(chunk, results):
+                all_stats[i] = freesound.FreesoundObject(analysis, self)
+        return all_stats
+
+    @staticmethod
+    def _parallel_map(function, tasks, processes, nb_files, Bar=None):
+        """ Yields function(task) for all the tasks (in order), computed in a pool of processes if there are many files """
+        pool = None
+        if nb_files < PARALLEL_MIN_FILES or processes == 1:
+            results = (function(task) for task in tasks)
+        else:
+            pool = multiprocessing.Pool(processes or multiprocessing.cpu_count())
+            results = pool.imap(function, tasks)
+        try:
+            done = 0
+            for task in tasks:
+                result = next(results)
+                done += len(task[0] if isinstance(task, tuple) else task)
+                if Bar:
+                    Bar.update(done)
+                yield result
+        finally:
+            if pool is not None:
+                pool.terminate()
+
+    def compute_analysis_stats(self, idsToCompute, chunk_size=500, overwrite=False):
+        """
+        Compute the analysis stats (mean, var, dmean, dmean2, dvar, dvar2, min, max) of sounds from their frames
+        cached in analysis/ and save them in analysis_stats/, instead of requesting them with my_get_analysis_stats().
+        The sounds are processed by chunks of chunk_size: for each descriptor, the stats of all the sounds of
+        a chunk are computed at once with RaggedFrames.stats().
+        Sounds that already have stats in local are skipped, unless overwrite is True.
+
+        >>> c.compute_analysis_stats(b.ids)
+        """
+        settings = SettingsSingleton()
+        local_analysis = set(settings.local_analysis)
+        local_analysis_stats = set(settings.local_analysis_stats)
+        ids = [i for i in idsToCompute if i in local_analysis and (overwrite or i not in local_analysis_stats)]
+        Bar = ProgressBar(len(ids), LENGTH_BAR, 'Computing analysis stats')
+        Bar.update(0)
+        for start in range(0, len(ids), chunk_size):
+            chunk_ids = ids[start:start + chunk_size]
+            all_frames = []
+            for idToLoad in chunk_ids:
+                with open('analysis/' + str(idToLoad) + '.json') as infile:
+                    all_frames.append(simplejson.load(infile))
+            for idSound, analysis in zip(chunk_ids, self._frames_to_stats(all_frames)):
+                with open('analysis_stats/' + str(idSound) + '.json', 'w') as outfile:
+                    json.dump(analysis, outfile)
+                if idSound not in local_analysis_stats:
+                    settings.local_analysis_stats.append(int(idSound))
+            Bar.update(start + len(chunk_ids))
+        settings.local_analysis_stats.sort()
+
+    @staticmethod
+    def _frames_to_stats(all_frames):
+        """
+        Returns the analysis stats dicts computed from the frames dicts of many sounds.
+        Only the framewise descriptors (FRAMEWISE_DESCRIPTORS) are aggregated, the other values are copied
+        unchanged like in the Freesound stats (eg lowlevel.average_loudness, rhythm.beats_position, tonal.key_key)
+        """
+        def flatten(d, prefix=''):
+            for k, v in d.iteritems():
+                if isinstance(v, dict):
+                    for item in flatten(v, prefix + k + '.'):
+                        yield item
+                else:
+                    yield prefix + k, v
+        def set_path(d, path, value):
+            keys = path.split('.')
+            for key in keys[:-1]:
+                d = d.setdefault(key, {})
+            d[keys[-1]] = value
+        def to_json(value):
+            return None if np.isnan(value) else float(value)
+
+        flat_frames = [dict(flatten(frames)) if frames else {} for frames in all_frames]
+        all_stats = [{} for _ in all_frames]
+        for path in set(flat_list([f.keys() for f in flat_frames])):
+            values = [f.get(path) for f in flat_frames]
+            if not any(fnmatch(path, pattern) for pattern in FRAMEWISE_DESCRIPTORS):
+                for idx, value in enumerate(values):
+                    if path in flat_frames[idx]:
+                        set_path(all_stats[idx], path, value)
+                continue
+            frames = [v if isinstance(v, list) and DescriptorSchema._width(v[0] if v else None) else None for v in values]
+            if any(f is not None for f in frames):
+                try:
+                    ragged = RaggedFrames.from_list(frames, np.float64)
+                except ValueError: # frames of different dimension
+                    continue
+                stats = ragged.stats()
+                for idx in np.where(ragged.mask)[0]:
+                    if ragged.ndim == 1:
+                        set_path(all_stats[idx], path, {name: to_json(s[idx, 0]) for name, s in stats.iteritems()})
+                    else:
+                        set_path(all_stats[idx], path, {name: [to_json(v) for v in s[idx]] for name, s in stats.iteritems()})
+            for idx, value in enumerate(values):
+                if frames[idx] is None and value is not None:
+                    set_path(all_stats[idx], path, value)
+        return all_stats
+
     def new_basket(self):
         """
         Create a new Basket
@@ -257,6 +456,33 @@ class Client(freesound.FreesoundClient):
         else:
             print '%s basket does not exist' % name
 
+    def load_basket_store(self, name, columns=None):
+        """
+        Load a basket saved with Basket.save_store()
+        Columns are memory mapped, give a list of columns to load only a part of them
+        (eg columns=['ids', 'tags'] does not decode the sounds json)
+        >>> b = c.load_basket_store('FreesoundDb', columns=['ids', 'tags', 'analysis_stats'])
+        """
+        settings = SettingsSingleton()
+        if name and name in settings.local_baskets_store:
+            store = BasketStore('baskets_store/' + name)
+            return store.read(self, columns)
+        else:
+            print '%s basket does not exist' % name
+
+    def open_basket_store(self, name):
+        """
+        Open a basket saved with Basket.save_store() without loading its sounds
+        Use it for baskets that do not fit in memory, the sounds are streamed with Basket.iter_chunks()
+        >>> b = c.open_basket_store('FreesoundDb')
+        >>> for chunk in b.iter_chunks(10000): ...
+        """
+        settings = SettingsSingleton()
+        if name and name in settings.local_baskets_store:
+            return BasketStore('baskets_store/' + name).open(self)
+        else:
+            print '%s basket does not exist' % name
+
     @staticmethod
     def save_pickle(obj, name, path=''):
         """
@@ -388,7 +614,7 @@ class Client(freesound.FreesoundClient):
                 analysis = []
                 for i in parser:
                     analysis.append(i)
-                analysis = array(analysis[0],float)
+                analysis = array(analysis[0], settings.frames_dtype)
             return analysis
         else:
             return None
@@ -446,8 +672,12 @@ class Client(freesound.FreesoundClient):
             os.makedirs('baskets')
         if not os.path.exists('baskets_pickle'):
             os.makedirs('baskets_pickle')
+        if not os.path.exists('baskets_store'):
+            os.makedirs('baskets_store')
         if not os.path.exists('previews'):
             os.makedirs('previews')
+        if not os.path.exists('corpus_cache'):
+            os.makedirs('corpus_cache')
         if not os.path.exists('analysis_stats'):
             os.makedirs('analysis_stats')
 
@@ -457,6 +687,7 @@ class Client(freesound.FreesoundClient):
         files_analysis = os.listdir('./analysis/')
         files_baskets = os.listdir('./baskets/')
         files_baskets_pickle = os.listdir('./baskets_pickle/')
+        files_baskets_store = os.listdir('./baskets_store/')
         files_analysis_stats = os.listdir('./analysis_stats/')
 
         settings = SettingsSingleton()
@@ -464,6 +695,7 @@ class Client(freesound.FreesoundClient):
         settings.local_analysis = []
         settings.local_baskets = []
         settings.local_baskets_pickle = []
+        settings.local_baskets_store = []
         settings.local_analysis_stats = []
 
         for i in files_sounds:
@@ -474,6 +706,9 @@ class Client(freesound.FreesoundClient):
             settings.local_baskets.append(m[:-5])
         for n in files_baskets_pickle:
             settings.local_baskets_pickle.append(n)
+        for s in files_baskets_store:
+            if os.path.exists('baskets_store/' + s + '/header.json'):
+                settings.local_baskets_store.append(s)
         for k in files_analysis_stats:
             settings.local_analysis_stats.append(int(k[:-5]))
         settings.local_sounds.sort()
@@ -556,49 +791,424 @@ class Client(freesound.FreesoundClient):
 #_________________________________________________________________#
 class Analysis():
     """
-    Analysis nested object. Holds all the analysis of many sounds
-
+    Holds all the analysis frames of many sounds in a flat dict {descriptor path: frames of all the sounds}
+    >>> analysis.frames['lowlevel.mfcc'] # [frames of sound 1, frames of sound 2, ...]
+    The nested access of the old Analysis object still works:
+    >>> analysis.lowlevel.mfcc
     """
-    def __init__(self, json_dict = None):
-        if not json_dict:
-            with open('analysis_template.json') as infile:
-                json_dict = simplejson.load(infile)
+    sentinel = object()
+    _template_paths = None # frozensets (groups, descriptors) of analysis_template.json, computed once per process
 
-        self.json_dict = json_dict
-        def replace_dashes(d):
-            for k, v in d.items():
-                if "-" in k:
-                    d[k.replace("-", "_")] = d[k]
-                    del d[k]
-                if isinstance(v, dict): replace_dashes(v)
+    def __init__(self, json_dict=None):
+        self.frames = {}
+        if json_dict:
+            self.frames.update(self._flatten(json_dict))
 
-        replace_dashes(json_dict)
-        self.__dict__.update(json_dict)
+    @staticmethod
+    def _flatten(json_dict, prefix=''):
+        flat = {}
         for k, v in json_dict.items():
+            path = prefix + k.replace('-', '_')
             if isinstance(v, dict):
-                self.__dict__[k] = Analysis(v)
+                flat.update(Analysis._flatten(v, path + '.'))
+            else:
+                flat[path] = v
+        return flat
+
+    @classmethod
+    def _template(cls):
+        if cls._template_paths is None:
+            template = analysis_template()
+            descriptors = cls._flatten(template).keys() if template else []
+            groups = set()
+            for d in descriptors: # all the parent groups, eg lowlevel and lowlevel.barkbands for lowlevel.barkbands.mean
+                parts = d.split('.')
+                groups.update('.'.join(parts[:i]) for i in range(1, len(parts)))
+            cls._template_paths = (frozenset(groups), frozenset(descriptors))
+        return cls._template_paths
+
+    def _is_group(self, path):
+        prefix = path + '.'
+        return any(d.startswith(prefix) for d in self.frames) or path in self._template()[0]
+
+    def __getattr__(self, name):
+        if name.startswith('__') or name == 'frames':
+            raise AttributeError(name)
+        return self.rgetattr(name)
 
     def rsetattr(self, attr, val):
-        pre, _, post = attr.rpartition('.')
-        return setattr(self.rgetattr(pre) if pre else self, post, val)
+        self.frames[attr.replace('-', '_')] = val
 
-    sentinel = object()
     def rgetattr(self, attr, default=sentinel):
+        attr = attr.replace('-', '_')
+        try:
+            return self.frames[attr]
+        except KeyError:
+            pass
+        if self._is_group(attr):
+            return AnalysisGroup(self, attr)
+        if attr in self._template()[1]: # descriptor not loaded, the empty list is kept so that it can be extended
+            return self.frames.setdefault(attr, [])
         if default is self.sentinel:
-            _getattr = getattr
-        else:
-            def _getattr(obj, name):
-                return getattr(obj, name, default)
-        return reduce(_getattr, [self] + attr.split('.'))
+            raise AttributeError(attr)
+        return default
 
     def remove(self, index, descriptor):
+        """ Remove the frames of the sound at index (or at the indexes in a list) for a descriptor, 'all' for all sounds """
         if index == 'all':
             self.rsetattr(descriptor, [])
+        elif isinstance(index, list):
+            analysis = self.rgetattr(descriptor)
+            index = [i for i in index if i < len(analysis)]
+            if isinstance(analysis, RaggedFrames):
+                analysis.delete(index)
+            else:
+                for i in sorted(index, reverse=True):
+                    del analysis[i]
         else:
             analysis = self.rgetattr(descriptor)
             del analysis[index]
 
 
+class AnalysisGroup:
+    """
+    View on a group of descriptors of an Analysis, used for the nested access (eg analysis.lowlevel)
+    """
+    def __init__(self, analysis, path):
+        self.__dict__['_analysis'] = analysis
+        self.__dict__['_path'] = path
+
+    def __getattr__(self, name):
+        if name.startswith('__'):
+            raise AttributeError(name)
+        return self._analysis.rgetattr(self._path + '.' + name)
+
+    def __setattr__(self, name, value):
+        self._analysis.rsetattr(self._path + '.' + name, value)
+
+
+#_________________________________________________________________#
+#                         Frames class                            #
+#_________________________________________________________________#
+class RaggedFrames:
+    """
+    Frames of one descriptor for many sounds, stored in one contiguous buffer
+        values  : (nb of frames of all the sounds, dimension) array
+        offsets : (nb sounds + 1) array, the frames of sound i are values[offsets[i]:offsets[i+1]]
+        mask    : False for the sounds that have no analysis (seen as None)
+    It behaves like the list of frames arrays it replaces (frames[i], len, iteration, del) and
+    frames[i] is a view on the buffer. Statistics over the frames of each sound are vectorised.
+
+    >>> frames = RaggedFrames.from_list([array1, None, array3])
+    >>> frames.mean()  # (nb sounds, dimension) array of the mean of each sound, nan for sounds with no frames
+    """
+    def __init__(self, values, offsets, mask=None, ndim=2):
+        self.values = values
+        self.offsets = np.asarray(offsets, dtype=np.int64)
+        self.mask = np.ones(len(self.offsets) - 1, dtype=bool) if mask is None else np.asarray(mask, dtype=bool)
+        self.ndim = ndim # 1 for descriptors with one value per frame, 0 for descriptors with a single value per sound
+
+    @classmethod
+    def from_list(cls, all_frames, dtype=None):
+        """ Create it from a list of frames arrays (None for the sounds with no analysis), dtype defaults to settings.frames_dtype """
+        dtype = dtype or SettingsSingleton().frames_dtype
+        frames = [np.asarray(f, dtype=dtype) for f in all_frames if f is not None]
+        ndim = max([f.ndim for f in frames] or [1])
+        frames = [f.reshape(f.shape[0], int(np.prod(f.shape[1:]))) if f.ndim else f.reshape(1, 1) for f in frames]
+        widths = set(f.shape[1] for f in frames if len(f))
+        if len(widths) > 1:
+            raise ValueError('the frames do not have the same dimension for all sounds')
+        width = widths.pop() if widths else 1
+        offsets = np.zeros(len(all_frames) + 1, dtype=np.int64)
+        frames_lengths = iter([len(f) for f in frames])
+        np.cumsum([next(frames_lengths) if f is not None else 0 for f in all_frames], out=offsets[1:])
+        frames = [f for f in frames if len(f)] # empty frames can have any width
+        values = np.concatenate(frames).reshape(-1, width) if frames else np.zeros((0, width), dtype=dtype)
+        return cls(values, offsets, [f is not None for f in all_frames], ndim)
+
+    @property
+    def lengths(self):
+        """ Number of frames of each sound """
+        return np.diff(self.offsets)
+
+    def __len__(self):
+        return len(self.mask)
+
+    def __getitem__(self, idx):
+        if idx < 0:
+            idx += len(self)
+        if not self.mask[idx]:
+            return None
+        frames = self.values[self.offsets[idx]:self.offsets[idx+1]]
+        if self.ndim == 0:
+            return frames[0, 0]
+        return frames[:, 0] if self.ndim == 1 else frames
+
+    def __iter__(self):
+        for idx in range(len(self)):
+            yield self[idx]
+
+    def __delitem__(self, idx):
+        self.delete([idx])
+
+    def to_list(self):
+        return list(self)
+
+    def _rows(self, sounds_mask):
+        """ Returns the mask of the frames rows belonging to the selected sounds """
+        return np.repeat(sounds_mask, self.lengths)
+
+    def delete(self, indexes):
+        """ Remove the frames of the sounds at the given indexes """
+        keep = np.ones(len(self), dtype=bool)
+        keep[list(indexes)] = False
+        self.values = self.values[self._rows(keep)]
+        lengths = self.lengths[keep]
+        self.offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=self.offsets[1:])
+        self.mask = self.mask[keep]
+
+    def take(self, indexes):
+        """ Returns a RaggedFrames with the frames of the sounds at the given indexes (in this order) """
+        indexes = np.asarray(indexes, dtype=np.int64)
+        lengths = self.lengths[indexes]
+        offsets = np.zeros(len(indexes) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=offsets[1:])
+        # position of each new row in the old buffer
+        rows = np.arange(offsets[-1]) - np.repeat(offsets[:-1] - self.offsets[indexes], lengths)
+        return RaggedFrames(self.values[rows], offsets, self.mask[indexes], self.ndim)
+
+    def extend(self, all_frames):
+        """ Append the frames of other sounds (list of frames arrays or RaggedFrames) """
+        if not isinstance(all_frames, RaggedFrames):
+            all_frames = RaggedFrames.from_list(all_frames, self.values.dtype)
+        values = all_frames.values.astype(self.values.dtype)
+        if not len(values): # no frames to add (empty or missing analysis), their width can be anything
+            values = values.reshape(0, self.values.shape[1])
+        elif not len(self.values):
+            self.values = self.values.reshape(0, values.shape[1])
+            self.ndim = all_frames.ndim
+        elif values.shape[1] != self.values.shape[1]:
+            raise ValueError('the frames do not have the same dimension for all sounds')
+        self.values = np.concatenate((self.values, values))
+        self.offsets = np.concatenate((self.offsets, all_frames.offsets[1:] + self.offsets[-1]))
+        self.mask = np.concatenate((self.mask, all_frames.mask))
+
+    def append(self, frames):
+        self.extend([frames])
+
+    # ___________________________ stats _____________________________ #
+    @staticmethod
+    def _reduce(ufunc, values, offsets, empty_value):
+        """ ufunc.reduceat over the segments of values, empty_value for the empty segments """
+        lengths = np.diff(offsets)
+        result = np.empty((len(lengths),) + values.shape[1:], dtype=np.float64)
+        result.fill(empty_value)
+        not_empty = lengths > 0
+        if not_empty.any():
+            result[not_empty] = ufunc.reduceat(values, offsets[:-1][not_empty], axis=0)
+        return result
+
+    def _moments(self, values, offsets):
+        """ Mean and variance of each segment (two passes in float64), nan for the empty segments """
+        lengths = np.diff(offsets)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            mean = self._reduce(np.add, values.astype(np.float64), offsets, 0.) / lengths[:, None]
+            centered = values - np.repeat(np.nan_to_num(mean), lengths, axis=0)
+            var = self._reduce(np.add, centered * centered, offsets, 0.) / lengths[:, None]
+        return mean, var
+
+    def derivative(self, values=None, offsets=None):
+        """ Absolute derivative of the frames of each sound (one frame less per sound), as (values, offsets) """
+        values = self.values if values is None else values
+        offsets = self.offsets if offsets is None else offsets
+        diff = np.abs(np.diff(values.astype(np.float64), axis=0))
+        # the difference between the last frame of a sound and the first of the next one is not a derivative
+        valid = np.ones(len(diff), dtype=bool)
+        starts = offsets[1:-1]
+        valid[starts[(starts > 0) & (starts <= len(diff))] - 1] = False
+        lengths = np.maximum(np.diff(offsets) - 1, 0)
+        new_offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=new_offsets[1:])
+        return diff[valid], new_offsets
+
+    def stats(self):
+        """
+        Returns a dict of (nb sounds, dimension) arrays with the stats of the frames of each sound:
+        mean, var, min, max, and mean and var of the absolute first (dmean, dvar) and second (dmean2, dvar2) derivatives.
+        The sounds with no analysis (or not enough frames) have nan values.
+        """
+        stats = {}
+        stats['mean'], stats['var'] = self._moments(self.values, self.offsets)
+        stats['min'] = self._reduce(np.minimum, self.values, self.offsets, np.nan)
+        stats['max'] = self._reduce(np.maximum, self.values, self.offsets, np.nan)
+        d_values, d_offsets = self.derivative()
+        stats['dmean'], stats['dvar'] = self._moments(d_values, d_offsets)
+        d2_values, d2_offsets = self.derivative(d_values, d_offsets)
+        stats['dmean2'], stats['dvar2'] = self._moments(d2_values, d2_offsets)
+        return stats
+
+    def mean(self):
+        return self._moments(self.values, self.offsets)[0]
+
+    def var(self):
+        return self._moments(self.values, self.offsets)[1]
+
+    def standardize(self):
+        """ Returns a RaggedFrames where the frames of each sound are scaled to zero mean and unit variance (like sklearn scale) """
+        mean, var = self._moments(self.values, self.offsets)
+        std = np.sqrt(var)
+        std[std == 0] = 1.
+        lengths = self.lengths
+        values = (self.values - np.repeat(np.nan_to_num(mean), lengths, axis=0)) / np.repeat(np.nan_to_num(std), lengths, axis=0)
+        return RaggedFrames(values.astype(self.values.dtype), self.offsets.copy(), self.mask.copy(), self.ndim)
+
+
+#_________________________________________________________________#
+#                    Descriptor schema class                      #
+#_________________________________________________________________#
+class DescriptorSchema:
+    """
+    Fixed layout of the columns of the descriptor stats matrix of a basket
+    fields : list of (path, width), eg [('lowlevel.mfcc.mean', 13), ('lowlevel.average_loudness', 1), ...]
+    The fields are put one after the other in this order, the path is split once in the keys used
+    to read the value in the analysis stats dict of each sound. Missing values are nan.
+
+    >>> schema = DescriptorSchema.compile(b.analysis_stats)
+    >>> matrix = schema.transform(b.analysis_stats) # (nb sounds, schema.width) float32 array
+    """
+    STATS = ['mean', 'dmean', 'dmean2', 'var', 'dvar', 'dvar2']
+    ALL_STATS = STATS + ['min', 'max']
+    CATEGORIES = ('lowlevel', 'sfx', 'tonal', 'rhythm')
+
+    def __init__(self, fields):
+        self.fields = [(path, int(width)) for path, width in fields]
+        self.offsets = np.zeros(len(self.fields) + 1, dtype=np.int64)
+        np.cumsum([width for _, width in self.fields], out=self.offsets[1:])
+        self._keys = [tuple(path.split('.')) for path, _ in self.fields]
+        self._selections = {}
+
+    @property
+    def width(self):
+        return int(self.offsets[-1])
+
+    @property
+    def columns(self):
+        """ Name of each column, with the position for vector descriptors (eg lowlevel.mfcc.mean.0) """
+        return flat_list([[path] if width == 1 else [path + '.' + str(i) for i in range(width)] for path, width in self.fields])
+
+    @classmethod
+    def compile(cls, analysis_stats, categories=('lowlevel',), stats=STATS, nb_sounds=100):
+        """
+        Compile the schema from the first nb_sounds analysis stats of a basket.
+        For each descriptor of the categories, the stats (mean, dmean, ...) are kept when the descriptor
+        has a 'mean' field, otherwise its value is taken directly (eg lowlevel.average_loudness).
+        Fields are sorted by category and descriptor name, so the layout does not depend on dict order.
+        """
+        widths = {}
+        count = 0
+        for analysis in analysis_stats:
+            if analysis is None:
+                continue
+            analysis = analysis.as_dict() if hasattr(analysis, 'as_dict') else analysis
+            if not isinstance(analysis, dict):
+                continue
+            for category in categories:
+                for descriptor, value in analysis.get(category, {}).iteritems():
+                    path = category + '.' + descriptor
+                    if isinstance(value, dict) and 'mean' in value:
+                        width = cls._width(value['mean'])
+                        for stat in stats:
+                            if stat in value:
+                                widths[path + '.' + stat] = max(widths.get(path + '.' + stat, 0), cls._width(value[stat]) or width)
+                    elif cls._width(value):
+                        widths[path] = max(widths.get(path, 0), cls._width(value))
+            count += 1
+            if count >= nb_sounds:
+                break
+        stat_order = dict((stat, idx) for idx, stat in enumerate(stats))
+        def sort_key(path):
+            category, descriptor, stat = (path.split('.') + [''])[:3]
+            return (categories.index(category), descriptor, stat_order.get(stat, -1))
+        return cls([(path, widths[path]) for path in sorted(widths, key=sort_key) if widths[path]])
+
+    @staticmethod
+    def _width(value):
+        """ Number of columns taken by a value, 0 if it is not numeric """
+        if isinstance(value, bool):
+            return 0
+        if isinstance(value, (int, long, float)):
+            return 1
+        if isinstance(value, list) and value and all(isinstance(v, (int, long, float)) for v in value):
+            return len(value)
+        return 0
+
+    def transform(self, analysis_stats, dtype=None):
+        """ Returns the (nb sounds, width) matrix of the stats, nan where a value is missing, dtype defaults to settings.features_dtype """
+        dtype = dtype or SettingsSingleton().features_dtype
+        matrix = np.empty((len(analysis_stats), self.width), dtype=dtype)
+        matrix.fill(np.nan)
+        fields = zip(self._keys, self.offsets[:-1], self.offsets[1:])
+        for row, analysis in enumerate(analysis_stats):
+            if analysis is None:
+                continue
+            analysis = analysis.as_dict() if hasattr(analysis, 'as_dict') else analysis
+            for keys, begin, end in fields:
+                value = analysis
+                try:
+                    for key in keys:
+                        value = value[key]
+                    if isinstance(value, list):
+                        value = value[:end - begin]
+                        matrix[row, begin:begin + len(value)] = [v if v is not None else np.nan for v in value]
+                    elif value is not None:
+                        matrix[row, begin] = value
+                except (KeyError, TypeError, ValueError): # missing or not numeric
+                    continue
+        return matrix
+
+    def select_columns(self, patterns):
+        """
+        Compile a list of descriptor paths or glob patterns (eg 'lowlevel.spectral_*.mean', 'lowlevel.mfcc.mean.0')
+        Returns (schema, columns): the schema holding only the matched fields, and the indexes
+        of the selected columns in its matrix, in the order of the patterns.
+        The result is kept for the next calls with the same patterns.
+        """
+        import fnmatch
+        key = tuple(patterns)
+        if key not in self._selections:
+            names = self.columns
+            selected = []
+            for pattern in patterns:
+                pattern = pattern.strip()
+                matched = [range(self.offsets[i], self.offsets[i+1]) for i, (path, _) in enumerate(self.fields) if fnmatch.fnmatchcase(path, pattern)]
+                columns = flat_list(matched) or [j for j, name in enumerate(names) if fnmatch.fnmatchcase(name, pattern)]
+                if not columns:
+                    raise ValueError('no descriptor matches %s' % pattern)
+                selected += [c for c in columns if c not in selected]
+            selected = np.array(selected, dtype=np.int64)
+            # keep only the fields holding a selected column, and move the columns indexes in the new layout
+            field_of_column = np.repeat(np.arange(len(self.fields)), np.diff(self.offsets))
+            fields = np.unique(field_of_column[selected])
+            schema = DescriptorSchema([self.fields[i] for i in fields])
+            shift = np.zeros(len(self.fields), dtype=np.int64)
+            shift[fields] = self.offsets[fields] - schema.offsets[:-1]
+            self._selections[key] = (schema, selected - shift[field_of_column[selected]], selected)
+        return self._selections[key][:2]
+
+    def column_indexes(self, patterns):
+        """ Returns the indexes in the matrix of this schema of the columns selected by the patterns (see select_columns) """
+        self.select_columns(patterns)
+        return self._selections[tuple(patterns)][2]
+
+    def to_json(self):
+        return [[path, width] for path, width in self.fields]
+
+    @classmethod
+    def from_json(cls, fields):
+        return cls(fields)
+
+
 #_________________________________________________________________#
 #                        Basket class                             #
 #_________________________________________________________________#
@@ -612,11 +1222,17 @@ class Basket:
 
     def __init__(self, client):
         self.sounds = []
-        self.analysis = Analysis() # the use of the nested object is not rly good...
+        self.analysis = Analysis()
         self.analysis_stats = []
         self.analysis_stats_names = []
         self.ids = []
         self.analysis_names = []
+        self.store = None # BasketStore holding the sounds when the basket is opened from a store
+        self._index = None # BasketIndex used by select(), built when needed
+        self._schema = None # DescriptorSchema of the analysis stats, compiled when needed
+        self._full_schema = None # DescriptorSchema of all the descriptors stats, used by select_descriptors()
+        self._stats_matrix = None # {dtype: matrix of all the descriptors stats}, used by select_descriptors()
+        self.tag_index = None # optional TagIndex kept up to date, see enable_tag_index()
 
         self.parent_client = client
         self._update_sound_client()
@@ -648,6 +1264,17 @@ class Basket:
     def _actualize(self): # used when an old basket is loaded from pickle
         if not hasattr(self, 'analysis_stats'):
             self.analysis_stats = []
+        if not hasattr(self, 'store'):
+            self.store = None
+        if not hasattr(self, 'tag_index'):
+            self.tag_index = None
+        if 'frames' not in vars(self.analysis): # nested Analysis object
+            old_analysis = self.analysis
+            self.analysis = Analysis()
+            for descriptor in self.analysis_names:
+                self.analysis.rsetattr(descriptor, reduce(getattr, [old_analysis] + descriptor.split('.')))
+        self._index = None
+        self._stats_matrix = None
 
     def _update_sound_client(self):
         for i, sound in enumerate(self.sounds):
@@ -665,6 +1292,9 @@ class Basket:
             if ids_old[i] not in self.ids:
                 self.ids.append(ids_old[i])
                 self.sounds.append(sounds_old[i])
+        self._index = None
+        self._stats_matrix = None
+        self._rebuild_tag_index()
         self.update_analysis()
     
     #________________________________________________________________________#
@@ -678,6 +1308,10 @@ class Basket:
         #sound.name = strip_non_ascii(sound.name)
         self.sounds.append(sound)
         self.analysis_stats.append(analysis_stat)
+        self._index = None
+        self._stats_matrix = None
+        if self.tag_index is not None:
+            self.tag_index.add(sound.tags if sound is not None else [])
         if sound is not None:
             self.ids.append(sound.id)      
         else:
@@ -693,6 +1327,10 @@ class Basket:
 
     def remove(self, index_list):
         index_list = sorted(index_list, reverse=True)
+        self._index = None
+        self._stats_matrix = None
+        if self.tag_index is not None:
+            self.tag_index.remove(index_list)
         for i in index_list:
             del self.ids[i]
             del self.sounds[i]
@@ -702,8 +1340,67 @@ class Basket:
                 pass
             if hasattr(self, 'clas'):
                 del self.clas[i]
-            for descriptor in self.analysis_names:
-                self.analysis.remove(i, descriptor)
+        for descriptor in self.analysis_names:
+            self.analysis.remove(index_list, descriptor)
+
+    def view(self, indexes):
+        """
+        Returns a Basket holding the sounds at the given indexes (in this order)
+        Sounds and analysis stats are shared with this basket (not copied), the frames of the selected sounds are copied
+        """
+        basket = Basket(self.parent_client)
+        basket.ids = [self.ids[i] for i in indexes]
+        basket.sounds = [self.sounds[i] for i in indexes]
+        nb_stats = len(self.analysis_stats)
+        basket.analysis_stats = [self.analysis_stats[i] if i < nb_stats else None for i in indexes]
+        for descriptor in self.analysis_names:
+            frames = self.analysis.rgetattr(descriptor)
+            if isinstance(frames, RaggedFrames) and all(i < len(frames) for i in indexes):
+                basket.analysis.rsetattr(descriptor, frames.take(indexes))
+            else:
+                basket.analysis.rsetattr(descriptor, [frames[i] if i < len(frames) else None for i in indexes])
+            basket.analysis_names.append(descriptor)
+        if hasattr(self, 'clas'):
+            basket.clas = [self.clas[i] if i < len(self.clas) else None for i in indexes]
+        basket._schema = getattr(self, '_schema', None)
+        return basket
+
+    def select(self, tags=None, duration=None, username=None, descriptors=None):
+        """
+        Returns a view (see view()) of the sounds matching all the given conditions
+        tags        : a tag or a list of tags that the sounds must all have
+        duration    : (min, max) range in seconds, None for an open bound
+        username    : a username or a list of usernames
+        descriptors : dict {descriptor path: (min, max)} on the analysis stats,
+                      add the position for vector descriptors (eg 'lowlevel.mfcc.mean.1')
+
+        >>> b_rain = b.select(tags=['rain', 'field-recording'], duration=(None, 30.))
+        >>> b_bright = b.select(descriptors={'lowlevel.spectral_centroid.mean': (3000., None)})
+        The indexes are built the first time and kept (see BasketIndex), call reindex() after modifying sounds directly
+        """
+        if self.store is not None and not self.sounds:
+            raise ValueError('the sounds of this basket are in its store, select in its chunks (see iter_chunks)')
+        if self._index is None or self._index.nb_sounds != len(self):
+            self._index = BasketIndex(self)
+        return self.view(self._index.select(tags, duration, username, descriptors))
+
+    def iter_chunks(self, size, columns=None):
+        """
+        Yields Baskets of at most size sounds.
+        If the basket was opened from a store (Client.open_basket_store), the chunks are read from the disk
+        one after the other (only the given columns), so that the whole collection never has to fit in memory.
+        Otherwise they are views of this basket.
+
+        >>> b = c.open_basket_store('FreesoundDb')
+        >>> for chunk in b.iter_chunks(10000, columns=['ids', 'analysis_stats']):
+        ...     features = chunk.extract_descriptor_stats()
+        """
+        if self.store is not None and not self.sounds:
+            for chunk in self.store.iter_chunks(self.parent_client, size, columns):
+                yield chunk
+        else:
+            for start in range(0, len(self), size):
+                yield self.view(range(start, min(start + size, len(self))))
 
     def remove_sounds_with_no_analysis(self):
         list_idx_to_remove = []
@@ -717,11 +1414,13 @@ class Basket:
         Use this method to load the sounds which ids are in the basket
         """
         nbSound = len(self.ids)
+        self._index = None
         Bar = ProgressBar(nbSound, LENGTH_BAR, 'Loading sounds')
         Bar.update(0)
         for i in range(nbSound):
             self.sounds.append(self.parent_client.my_get_sound(self.ids[i]))
             Bar.update(i+1)
+        self._rebuild_tag_index()
 
     def add_analysis(self, descriptor):
         """
@@ -737,25 +1436,25 @@ class Basket:
             print 'The %s analysis are already loaded' % descriptor
         else:
             nbSound = len(self.ids)
-            allFrames = []
             Bar = ProgressBar(nbSound,LENGTH_BAR, 'Loading ' + descriptor + ' analysis')
             Bar.update(0)
-            for i in range(nbSound):
-                allFrames.append(self.parent_client.my_get_analysis(self.ids[i], descriptor))
-                Bar.update(i+1)
+            allFrames = self.parent_client.my_get_analysis_parallel(self.ids, descriptor, Bar=Bar)
+            Bar.update(nbSound)
             self.analysis_names.append(descriptor)
             self.analysis.rsetattr(descriptor, allFrames)
 
     def update_analysis(self):
         for nameAnalysis in self.analysis_names:
             allFrames = self.analysis.rgetattr(nameAnalysis)
+            if not isinstance(allFrames, RaggedFrames): # empty list of a descriptor not loaded yet, or old list of frames
+                allFrames = RaggedFrames.from_list(allFrames)
             nbAnalysis = len(allFrames)
             nbAnalysisToLoad = len(self.ids) - nbAnalysis
             Bar = ProgressBar(nbAnalysisToLoad, LENGTH_BAR, 'Loading ' + nameAnalysis + ' analysis')
             Bar.update(0)
-            for i in range(nbAnalysisToLoad):
-                Bar.update(i + 1)
-                allFrames.append(self.parent_client.my_get_analysis(self.ids[i+nbAnalysis], nameAnalysis))
+            allFrames.extend(self.parent_client.my_get_analysis_parallel(self.ids[nbAnalysis:], nameAnalysis, Bar=Bar))
+            self.analysis.rsetattr(nameAnalysis, allFrames)
+            Bar.update(nbAnalysisToLoad)
 
     def add_analysis_stats(self):
         """
@@ -764,23 +1463,24 @@ class Basket:
         """
         #self.analysis_stats = []
         nbSounds = len(self.sounds)
+        self._index = None
+        self._schema = None
+        self._full_schema = None
+        self._stats_matrix = None
         Bar = ProgressBar(nbSounds, LENGTH_BAR, 'Loading analysis stats')
         Bar.update(0)
-        for i, sound in enumerate(self.sounds):
-            Bar.update(i + 1)
-            if sound is not None:
-                analysis = self.parent_client.my_get_analysis_stats(sound.id)
-                self.analysis_stats[i] = analysis
-            else:
-                self.analysis_stats[i] = None # HERE CHANGED APPEND TO I, is it ok ?
-                # try:
-                #     self.analysis_stats.append(sound.get_analysis())
-                # except freesound.FreesoundException:
-                #     pass
+        all_stats = self.parent_client.my_get_analysis_stats_parallel([sound.id if sound is not None else None for sound in self.sounds], Bar=Bar)
+        Bar.update(nbSounds)
+        for i, analysis in enumerate(all_stats):
+            self.analysis_stats[i] = analysis
 
 	# FUNCTION FOR ADDING STATS OF ONLY ONE ANALYSIS
     def add_one_analysis_stats(self, descriptor):
         nbSounds = len(self.sounds)
+        self._index = None
+        self._schema = None
+        self._full_schema = None
+        self._stats_matrix = None
         Bar = ProgressBar(nbSounds, LENGTH_BAR, 'Loading analysis stats')
         Bar.update(0)
         for i, sound in enumerate(self.sounds):
@@ -792,6 +1492,25 @@ class Basket:
                 self.analysis_stats[i] = None
 		
 		
+    def compute_analysis_stats(self, chunk_size=500, overwrite=False):
+        """
+        Compute the analysis stats of the sounds from their cached frames (see Client.compute_analysis_stats)
+        and load them in the basket
+        """
+        self.parent_client.compute_analysis_stats([i for i in self.ids if i is not None], chunk_size, overwrite)
+        self.add_analysis_stats()
+
+    def frames_stats(self, descriptor):
+        """
+        Returns the stats of the loaded frames of a descriptor for all the sounds (see RaggedFrames.stats)
+        >>> b.add_analysis('lowlevel.mfcc')
+        >>> b.frames_stats('lowlevel.mfcc')['dmean']
+        """
+        frames = self.analysis.rgetattr(descriptor)
+        if not isinstance(frames, RaggedFrames):
+            frames = RaggedFrames.from_list(frames)
+        return frames.stats()
+
     def remove_analysis(self, descriptor):
         if descriptor in self.analysis_names:
             self.analysis.remove('all', descriptor)
@@ -842,76 +1561,88 @@ class Basket:
                 Bar.update(numSound+1)
             results_pager_last = results_pager
 
-    def extract_descriptor_stats(self, scale=False):
+    def descriptor_schema(self):
         """
-        Returns a list of the scaled and concatenated descriptor stats - mean and var (all the one that are loaded in the Basket) for all sounds in the Basket.
+        Returns the DescriptorSchema giving the columns of extract_descriptor_stats()
+        It is compiled from the analysis stats the first time, and kept for the next calls
         """
-        feature_vector = []
-        for analysis_stats in self.analysis_stats:
-            feature_vector_single_sound = []
-            for k, v in analysis_stats.as_dict().iteritems():
-                if k == 'lowlevel':
-                    for k_, v_ in v.iteritems():
-                        try: # some lowlevel descriptors do not have 'mean' 'var' field (eg average_loudness)    
-                            # barkbands_kurtosis has 0 variance and that bring dvar and dvar2 to be None...
-                            if isinstance(v_['mean'], list):
-                                feature_vector_single_sound += v_['mean'] # take the mean
-                                feature_vector_single_sound += v_['dmean']
-                                feature_vector_single_sound += v_['dmean2']
-                                feature_vector_single_sound += v_['var'] # var
-                                feature_vector_single_sound += v_['dvar']
-                                feature_vector_single_sound += v_['dvar2']                                
-                            elif isinstance(v_['mean'], float):
-                                feature_vector_single_sound.append(v_['mean']) # for non array
-                                feature_vector_single_sound.append(v_['dmean'])
-                                feature_vector_single_sound.append(v_['dmean2'])
-                                feature_vector_single_sound.append(v_['var'])
-                                if k_ != 'barkbands_kurtosis': # this descriptor has variance = 0 => produce None values for dvar and dvar2
-                                    feature_vector_single_sound.append(v_['dvar'])
-                                    feature_vector_single_sound.append(v_['dvar2'])
-                        except: # here we suppose that v_ is already a number to be stored 
-                            if isinstance(v_, list):
-                                feature_vector_single_sound += v_
-                            elif isinstance(v_, float):
-                                feature_vector_single_sound.append(v_)
-                elif k == 'other cat of descriptors':
-                    # sfx, tonal, rhythm
-                    pass
-            feature_vector.append(feature_vector_single_sound)
-        if scale:  
-            return preprocessing.scale(feature_vector)
-        else:
-            return feature_vector
-        
-    def extract_one_descriptor_stats(self, scale=False):
+        if getattr(self, '_schema', None) is None:
+            self._schema = DescriptorSchema.compile(self.analysis_stats)
+        return self._schema
+
+    def extract_descriptor_stats(self, scale=False, schema=None, missing=0., dtype=None):
+        """
+        Returns the (nb sounds, nb features) matrix (dtype, settings.features_dtype by default) of the lowlevel descriptor stats (mean, dmean, dmean2, var, dvar, dvar2)
+        of the sounds in the Basket. The columns are given by schema (by default descriptor_schema()).
+        Missing values (sound without analysis stats, None stats) are replaced by missing after the scaling,
+        use missing=None to keep them as nan.
+        """
+        schema = schema or self.descriptor_schema()
+        return self._scale_features(schema.transform(self.analysis_stats, dtype), scale, missing)
+
+    def select_descriptors(self, patterns, scale=False, missing=0., dtype=None):
         """
-        A bit dirty. Maybe review de concept of analysis_stat and analysis objects
+        Returns the matrix of the selected descriptor stats, see DescriptorSchema.select_columns()
+        for the patterns (a list or a comma separated string). Scaling and missing values as in extract_descriptor_stats()
+
+        >>> b.select_descriptors(['lowlevel.spectral_*.mean', 'lowlevel.mfcc.mean', 'sfx.inharmonicity.*'])
+        """
+        if isinstance(patterns, basestring):
+            patterns = patterns.split(',')
+        if getattr(self, '_full_schema', None) is None:
+            self._full_schema = DescriptorSchema.compile(self.analysis_stats, DescriptorSchema.CATEGORIES, DescriptorSchema.ALL_STATS)
+        dtype = np.dtype(dtype or SettingsSingleton().features_dtype)
+        if getattr(self, '_stats_matrix', None) is None:
+            self._stats_matrix = {}
+        if dtype not in self._stats_matrix:
+            # the stats of all the descriptors are put in a matrix once, the selections only index its columns
+            self._stats_matrix[dtype] = self._full_schema.transform(self.analysis_stats, dtype)
+        return self._scale_features(self._stats_matrix[dtype][:, self._full_schema.column_indexes(patterns)], scale, missing)
+
+    @staticmethod
+    def _scale_features(feature_vector, scale, missing):
+        if scale:
+            with warnings.catch_warnings(): # columns with only nan values
+                warnings.simplefilter('ignore', RuntimeWarning)
+                mean = np.nanmean(feature_vector, axis=0, dtype=np.float64) # accumulate in float64 for float32 matrices
+                std = np.nanstd(feature_vector, axis=0, dtype=np.float64)
+            mean[np.isnan(mean)] = 0.
+            std[~(std > 0)] = 1.
+            feature_vector = ((feature_vector - mean) / std).astype(feature_vector.dtype)
+        if missing is not None:
+            feature_vector[np.isnan(feature_vector)] = missing
+        return feature_vector
+
+    def iter_descriptor_stats(self, size):
+        """
+        Yields the descriptor stats (see extract_descriptor_stats) of the sounds by chunks of size sounds
+        """
+        if self.store is not None and not self.sounds and self.store.descriptor_schema() is not None:
+            # the stats matrix is saved in the store
+            for start in range(0, len(self), size):
+                feature_vector = np.array(self.store.read_descriptor_stats(start, start + size), dtype=SettingsSingleton().features_dtype)
+                feature_vector[np.isnan(feature_vector)] = 0.
+                yield feature_vector
+            return
+        schema = None
+        for chunk in self.iter_chunks(size, columns=['ids', 'analysis_stats']):
+            schema = schema or chunk.descriptor_schema() # same columns for all the chunks
+            yield chunk.extract_descriptor_stats(schema=schema)
+
+    def extract_one_descriptor_stats(self, scale=False, missing=0., dtype=None):
         """
-        feature_vector = []
+        Returns the matrix of the stats (mean, dmean, dmean2, var, dvar, dvar2) of the descriptor loaded
+        with add_one_analysis_stats(). None stats (eg dvar of barkbands_kurtosis) are missing values.
+        """
+        widths = {}
         for analysis_stats in self.analysis_stats:
-            feature_vector_single_sound = []
-            if isinstance(getattr(analysis_stats,'mean'), list):
-                feature_vector_single_sound += getattr(analysis_stats,'mean') # take the mean
-                feature_vector_single_sound += getattr(analysis_stats,'dmean')
-                feature_vector_single_sound += getattr(analysis_stats,'dmean2')
-                feature_vector_single_sound += getattr(analysis_stats,'var') # var
-                feature_vector_single_sound += getattr(analysis_stats,'dvar')
-                feature_vector_single_sound += getattr(analysis_stats,'dvar2')                                
-            elif isinstance(getattr(analysis_stats,'mean'), float):
-                feature_vector_single_sound.append(getattr(analysis_stats,'mean')) # for non array
-                feature_vector_single_sound.append(getattr(analysis_stats,'dmean'))
-                feature_vector_single_sound.append(getattr(analysis_stats,'dmean2'))
-                feature_vector_single_sound.append(getattr(analysis_stats,'var'))
-                if k_ != 'barkbands_kurtosis': # this descriptor has variance = 0 => produce None values for dvar and dvar2
-                    feature_vector_single_sound.append(getattr(analysis_stats,'dvar'))
-                    feature_vector_single_sound.append(getattr(analysis_stats,'dvar2'))
-            feature_vector.append(feature_vector_single_sound)
-        if scale:  
-            return preprocessing.scale(feature_vector)
-        else:
-            return feature_vector
-        
-    
+            if analysis_stats is not None:
+                analysis_stats = analysis_stats.as_dict() if hasattr(analysis_stats, 'as_dict') else analysis_stats
+                for stat in DescriptorSchema.STATS:
+                    widths[stat] = max(widths.get(stat, 0), DescriptorSchema._width(analysis_stats.get(stat)))
+        schema = DescriptorSchema([(stat, widths[stat]) for stat in DescriptorSchema.STATS if widths.get(stat)])
+        return self._scale_features(schema.transform(self.analysis_stats, dtype), scale, missing)
+
     def load_sounds(self, results_pager, begin_idx=0, debugger=None):
         """
         Use this method to load all the sounds from a result pager int the basket
@@ -1021,70 +1752,106 @@ class Basket:
             else:
                 print 'Basket was not saved'
 
+    def save_store(self, name):
+        """
+        Use this method to save a basket in the binary store (see BasketStore)
+        It is much faster to load than a pickle and does not depend on the classes layout
+        >>> b.save_store('myBasket')
+        >>> b = c.load_basket_store('myBasket')
+        """
+        settings = SettingsSingleton()
+        if name and not (name in settings.local_baskets_store):
+            BasketStore('baskets_store/' + name).write(self)
+            settings.local_baskets_store.append(name)
+        else:
+            overwrite = raw_input(name + ' basket already exists. Do you want to replace it ? (y/n)')
+            if overwrite == 'y':
+                BasketStore('baskets_store/' + name).write(self)
+            else:
+                print 'Basket was not saved'
+
     #________________________________________________________________________#
     # __________________________ Language tools _____________________________#
     # TODO: CREATE A CLASS FOR THIS TOOLS, AND SEPARATE FROM BASKET 
     
     def tags_lower(self):
+        self._index = None
         for idx, s in enumerate(self.sounds):
             self.sounds[idx].tags = [t.lower() for t in s.tags]
+            if self.tag_index is not None:
+                self.tag_index.update(idx, self.sounds[idx].tags)
     
     def text_preprocessing(self):
-        stemmer = PorterStemmer()
+        self._index = None
+        preprocessor = TextPreprocessor.shared()
         for idx, s in enumerate(self.sounds):
-            self.sounds[idx].tags = [stemmer.stem(t.lower()) for t in s.tags]
+            self.sounds[idx].tags = preprocessor.tag_terms(s.tags)
+            if self.tag_index is not None:
+                self.tag_index.update(idx, self.sounds[idx].tags)
 
-    def return_tags_occurrences_dict(self):
-        #tags = self.tags_extract_all()
-        tags = list(set(flat_list([sound.tags for sound in self.sounds])))
-        #default_value = [0, []]
-        tags_occurrences = {key:[0, []] for key in tags}
-        Bar = ProgressBar(len(self.sounds), LENGTH_BAR, 'Counting')
-        Bar.update(0)
-        for idx, sound in enumerate(self.sounds):
-            Bar.update(idx+1)
-            for tag in sound.tags:
-                tags_occurrences[tag][0] += 1
-                tags_occurrences[tag][1].append(sound.id)
-        return tags_occurrences
-    
-    def return_tags_occurrences(self):
-        #tags = self.tags_extract_all()
-        tags = list(set(flat_list([sound.tags for sound in self.sounds])))
-        #default_value = [0, []]
-        tags_occurrences = {key:[0, []] for key in tags}
-        Bar = ProgressBar(len(self.sounds), LENGTH_BAR, 'Counting')
-        Bar.update(0)
-        for idx, sound in enumerate(self.sounds):
-            Bar.update(idx+1)
-            for tag in sound.tags:
-                tags_occurrences[tag][0] += 1
-                tags_occurrences[tag][1].append(sound.id)
-        # putting it in the old format for compatibility with other methods:  
-        #list of tuples (tag, nb_occurrences, [sound ids])
-        all_tags_occurrences = []
-        for t in tags_occurrences.keys():
-            all_tags_occurrences.append((t, tags_occurrences[t][0], tags_occurrences[t][1]))
+    def enable_tag_index(self):
+        """
+        Keep a TagIndex up to date in push(), remove(), tags_lower() and text_preprocessing(),
+        so that tags_occurrences() and tag queries do not rescan the sounds.
+        Tags modified directly on the sounds are not seen by the index, call enable_tag_index() again after that.
+        >>> b.enable_tag_index()
+        >>> b.tag_index.count('wind')
+        """
+        self.tag_index = None
+        self._rebuild_tag_index(force=True)
+
+    def disable_tag_index(self):
+        self.tag_index = None
+
+    def reindex(self):
+        """
+        Drop the indexes of select() and rebuild the TagIndex (if enabled),
+        use it after modifying the sounds directly (eg sound.tags = ...)
+        """
+        self._index = None
+        self._rebuild_tag_index()
+
+    def _rebuild_tag_index(self, force=False):
+        if self.tag_index is not None or force:
+            self.tag_index = TagIndex(sound.tags if sound is not None else [] for sound in self.sounds)
+
+    def tags_index(self):
+        """
+        Returns the inverted tag index {tag: sorted array of the positions of the sounds having this tag}, built in one pass.
+        It is rebuilt at each call because the tags of the sounds can be modified directly,
+        unless the basket keeps a tag index (see enable_tag_index)
+        """
+        return BasketIndex(self).tags()
+
+    @staticmethod
+    def _sorted_occurrences(all_tags_occurrences):
+        """ Sort the list of tuples (tag, nb_occurrences, ...) by number of occurrences, most frequent first """
         all_tags_occurrences = sorted(all_tags_occurrences, key=lambda oc: oc[1])
         all_tags_occurrences.reverse()
-        return all_tags_occurrences        
-        
+        return all_tags_occurrences
+
+    def return_tags_occurrences_dict(self):
+        """
+        Returns a dict {tag: [nb_occurrences, [sound ids]]}
+        """
+        ids = [sound.id if sound is not None else None for sound in self.sounds]
+        return {tag: [len(positions), [ids[i] for i in positions]] for tag, positions in self.tags_index().iteritems()}
+
+    def return_tags_occurrences(self):
+        """
+        Returns a list of tuples (tag, nb_occurrences, [sound ids])
+        The list is sorted by number of occurrences of tags
+        """
+        ids = [sound.id if sound is not None else None for sound in self.sounds]
+        return self._sorted_occurrences([(tag, len(positions), [ids[i] for i in positions]) for tag, positions in self.tags_index().iteritems()])
+
     def tags_occurrences(self):
         """
         Returns a list of tuples (tag, nb_occurrences, [sound ids])
         The list is sorted by number of occurrences of tags
+        Here sound ids are the positions of the sounds in the basket (use return_tags_occurrences for Freesound ids)
         """
-        all_tags_occurrences = []
-        tags = self.tags_extract_all()
-        Bar = ProgressBar(len(tags), LENGTH_BAR, 'Thinking ...')
-        Bar.update(0)
-        for idx, tag in enumerate(tags):
-            Bar.update(idx+1)
-            tag_occurrences = self.tag_occurrences(tag)
-            all_tags_occurrences.append((tag, tag_occurrences[0], tag_occurrences[1]))
-        all_tags_occurrences = sorted(all_tags_occurrences, key=lambda oc: oc[1])
-        all_tags_occurrences.reverse()
-        return all_tags_occurrences
+        return self._sorted_occurrences([(tag, len(positions), positions.tolist()) for tag, positions in self.tags_index().iteritems()])
 
     def terms_occurrences(self, terms_sounds):
         """
@@ -1096,17 +1863,8 @@ class Basket:
                     nlp(basket, t_o) 
                     WARNING: nlp check the tags only... !!!!!!!!!!
         """
-        all_terms_occurrences = []
-        terms = list(set([item for sublist in terms_sounds for item in sublist]))
-        Bar = ProgressBar(len(terms), LENGTH_BAR, 'Thinking ...')
-        Bar.update(0)
-        for idx, term in enumerate(terms):
-            Bar.update(idx+1)
-            term_occurrences = self.term_occurrences(terms_sounds, term)
-            all_terms_occurrences.append((term, term_occurrences[0], term_occurrences[1]))
-        all_terms_occurrences = sorted(all_terms_occurrences, key=lambda oc: oc[1])
-        all_terms_occurrences.reverse()
-        return all_terms_occurrences
+        postings = BasketIndex._postings(terms_sounds)
+        return self._sorted_occurrences([(term, len(positions), positions.tolist()) for term, positions in postings.iteritems()])
 
     def term_occurrences(self, l, term):
         ids = []
@@ -1134,14 +1892,14 @@ class Basket:
         return number, ids
 
     def tags_extract_all(self):
+        """ Returns the list of all the tags, in order of first appearance """
         tags = []
-        Bar = ProgressBar(len(self.sounds), LENGTH_BAR, 'Extracting tags')
-        Bar.update(0)
-        for idx, sound in enumerate(self.sounds):
-            Bar.update(idx + 1)
+        seen = set()
+        for sound in self.sounds:
             if sound is not None:
                 for tag in sound.tags:
-                    if tag not in tags:
+                    if tag not in seen:
+                        seen.add(tag)
                         tags.append(tag)
         return tags
     
@@ -1154,85 +1912,141 @@ class Basket:
             sound_tag_dict[sound.id] = sound.tags
         return sound_tag_dict
     
-    def get_preprocessed_descriptions_word2vec(self):
+    def get_preprocessed_descriptions_word2vec(self, processes=None):
         """
         Returns a list of sentences from sound descriptions in the basket.
         Preprocessing is done (remove special characters, Porter Stemming, lower case)
         """
-        stemmer = PorterStemmer()
-        delimiters = '.', '?', '!', ':'
-        def split(delimiters, string, maxsplit=0):
-            regexPattern = '|'.join(map(re.escape, delimiters))
-            return re.split(regexPattern, string, maxsplit)
-        
-        all_descriptions = [a.description.lower() for a in self.sounds]
-        sentences = []
-        
-        for description in all_descriptions:
-            string = description.replace('\r\n', ' ')
-            string = string.replace('(', ' ')
-            string = string.replace(')', ' ')
-            string = string.replace('*', '')
-            string = string.replace('-', '')
-            string = string.replace('#', '')
-            string = string.replace(',', '')
-            string = string.replace('/', '')
-            string = re.sub('<a href(.)+>', ' ', string)
-            string = split(delimiters, string)
-            for string_sentence in string:
-                if string_sentence is not u'':
-                    terms_to_append = [stemmer.stem(a) for a in string_sentence.split()]
-                    sentences.append(terms_to_append)
+        return flat_list(TextPreprocessor.shared().map('sentences', [(sound.description,) for sound in self.sounds], processes))
     
-        return sentences
-    
-    def word2vec(self, sentences, size=50):
+    def word2vec(self, sentences=None, size=50, epochs=5, workers=None, checkpoint=None):
+        """
+        Train a word2vec model on sentences (any restartable iterable of lists of terms),
+        by default on the StreamingCorpus of the preprocessed tags and descriptions of the basket.
+        workers: number of cores used, all of them by default
+        checkpoint: file where the model is saved after each epoch, an interrupted training is resumed from it
+        >>> model = b.word2vec(checkpoint='w2v.model')
+        """
         from gensim.models import Word2Vec
-        return Word2Vec(sentences, size=size, window=500, min_count=10, workers=8)
+        if sentences is None:
+            sentences = self.streaming_corpus()
+        return self._train_embeddings(Word2Vec, sentences, epochs, workers, checkpoint,
+                                      size=size, window=500, min_count=10)
     
-    def doc2vec(self, documents, size=50):
+    def doc2vec(self, documents=None, size=50, epochs=5, workers=None, checkpoint=None):
         """ 
         This method seems to give worse result on returning most similar terms for violin, bright
+        Same parameters as word2vec, documents are TaggedDocuments (by default the StreamingCorpus tagged
+        with the position of the sounds in the basket)
         """
         from gensim.models import Doc2Vec
-        return Doc2Vec(documents, size=size, window=500, min_count=10, workers=8)
+        if documents is None:
+            documents = self.streaming_corpus(tagged=True)
+        return self._train_embeddings(Doc2Vec, documents, epochs, workers, checkpoint,
+                                      size=size, window=500, min_count=10)
+
+    @staticmethod
+    def _train_embeddings(model_class, corpus, epochs, workers, checkpoint, **params):
+        """ Train a gensim model one epoch after the other, the learning rate decays linearly over all the epochs """
+        workers = workers or multiprocessing.cpu_count()
+        if checkpoint is not None and os.path.exists(checkpoint):
+            model = model_class.load(checkpoint)
+            model.workers = workers
+            print 'Resuming training from %s, %d/%d epochs done' % (checkpoint, model.epochs_done, epochs)
+        else:
+            model = model_class(workers=workers, **params)
+            model.build_vocab(corpus)
+            model.epochs_done = 0
+            model.alpha_schedule = (model.alpha, model.min_alpha) # alpha and min_alpha are changed at each epoch
+        start_alpha, end_alpha = model.alpha_schedule
+        decay = (start_alpha - end_alpha) / epochs
+        # one epoch from alpha to min_alpha (gensim 1.0 API), later versions also need the epochs count
+        options = {'epochs': 1} if 'epochs' in inspect.getargspec(model.train).args else {}
+        Bar = ProgressBar(epochs, LENGTH_BAR, 'Training %s' % model_class.__name__)
+        Bar.update(min(model.epochs_done, epochs))
+        while model.epochs_done < epochs:
+            model.iter = 1
+            model.alpha = start_alpha - decay * model.epochs_done
+            model.min_alpha = start_alpha - decay * (model.epochs_done + 1)
+            model.train(corpus, total_examples=model.corpus_count, **options)
+            model.epochs_done += 1
+            if checkpoint is not None:
+                model.save(checkpoint + '.tmp')
+                os.rename(checkpoint + '.tmp', checkpoint)
+            Bar.update(model.epochs_done)
+        return model
+
+    def streaming_corpus(self, chunk_size=10000, processes=None, tagged=False):
+        """
+        Returns the StreamingCorpus of the preprocessed tags and descriptions (see preprocessing_tag_description).
+        The corpus is built chunk by chunk in the CorpusCache the first time, without keeping it in memory.
+        """
+        preprocessor = TextPreprocessor.shared()
+        corpus_cache = CorpusCache()
+        key = corpus_cache.key(self, 'tag_description_terms', preprocessor.params())
+        if not corpus_cache.exists(key):
+            chunks = (preprocessor.map('tag_description_terms', [(sound.tags, sound.description) for sound in chunk.sounds], processes)
+                      for chunk in self.iter_chunks(chunk_size, columns=['ids', 'tags', 'description']))
+            corpus_cache.put_chunks(key, chunks, 'tag_description_terms', preprocessor.params())
+        return StreamingCorpus(os.path.join(corpus_cache.path, key), chunk_size, tagged)
     
-    def preprocessing_tag_description(self):
+    def preprocessing_tag_description(self, processes=None, cache=False):
         """
-        Preprocessing tags and descriptions
+        Preprocessing tags and descriptions (see TextPreprocessor)
         Returns an array containing arrays of terms for each sound
         Steps for descriptions : Lower case, remove urls, Tokenization, remove stop words, Stemming (Porter)
                     tags       : Lower case, Stemming
-        """
-        stemmer = PorterStemmer()
-        en_stop = get_stop_words('en') + ['freesound', 'org']
-        
-        all_descriptions = [[stemmer.stem(word) for word in CountVectorizer().build_tokenizer()(re.sub('<a href(.)+/a>', ' ', sound.description.lower())) if word not in en_stop] for sound in self.sounds]
-        all_tags = [[stemmer.stem(tag.lower()) for tag in sound.tags] for sound in self.sounds]
-        
-        return [tag + description for tag, description in zip(all_tags, all_descriptions)]
+        Big baskets are processed in a pool of processes (processes, one per core by default)
+        With cache=True the result is saved in the CorpusCache and loaded from it the next times
+        """
+        preprocessor = TextPreprocessor.shared()
+        if cache:
+            corpus_cache = CorpusCache()
+            key = corpus_cache.key(self, 'tag_description_terms', preprocessor.params())
+            documents = corpus_cache.get(key)
+            if documents is not None:
+                return documents
+        documents = preprocessor.map('tag_description_terms', [(sound.tags, sound.description) for sound in self.sounds], processes)
+        if cache:
+            corpus_cache.put(key, documents, 'tag_description_terms', preprocessor.params())
+        return documents
     
+    def iter_preprocessing_tag_description(self, size):
+        """
+        Yields the preprocessed tags and descriptions (see preprocessing_tag_description) by chunks of size sounds
+        """
+        for chunk in self.iter_chunks(size, columns=['ids', 'tags', 'description']):
+            yield chunk.preprocessing_tag_description()
+
     def preprocessing_tag(self):
-        stemmer = PorterStemmer()
-        return [[stemmer.stem(tag.lower()) for tag in sound.tags] for sound in self.sounds]
+        preprocessor = TextPreprocessor.shared()
+        return [preprocessor.tag_terms(sound.tags) for sound in self.sounds]
     
-    def preprocessing_doc2vec(self):
+    def preprocessing_doc2vec(self, processes=None):
         from gensim.models.doc2vec import TaggedDocument
-        stemmer = PorterStemmer()
-        en_stop = get_stop_words('en') + ['freesound', 'org']
-        
-        all_descriptions = [[stemmer.stem(word) for word in CountVectorizer().build_tokenizer()(re.sub('<a href(.)+/a>', ' ', sound.description.lower())) if word not in en_stop] for sound in self.sounds]
-        all_tags = [[stemmer.stem(tag.lower()) for tag in sound.tags] for sound in self.sounds]
+        preprocessor = TextPreprocessor.shared()
+        all_descriptions = preprocessor.map('description_terms', [(sound.description,) for sound in self.sounds], processes)
+        all_tags = [preprocessor.tag_terms(sound.tags) for sound in self.sounds]
         
         return [TaggedDocument(words, tags) for words, tags in zip(all_descriptions, all_tags)]
         
     class TfidfEmbeddingVectorizer(object):
-        def __init__(self, w2v_model):
-            self.word2vec = dict(zip(w2v_model.index2word, w2v_model.syn0))
+        """
+        Documents embeddings: tf-idf weighted mean of the word2vec vectors of their terms.
+        Computed as the sparse (docs, vocabulary) tf-idf matrix multiplied by the (vocabulary, dim) embeddings matrix.
+        norm='l2' normalises the embeddings of the documents
+        >>> t = b.TfidfEmbeddingVectorizer(model).fit(docs)
+        >>> X = t.transform(docs)
+        """
+        def __init__(self, w2v_model, norm=None):
+            self.vocabulary = {w: i for i, w in enumerate(w2v_model.index2word)}
+            self.embeddings = np.asarray(w2v_model.syn0, dtype=np.float32)
             self.word2weight = None
-            self.dim = len(w2v_model.syn0[0])
+            self.idf = None
+            self.dim = self.embeddings.shape[1]
+            self.norm = norm
 
-        def fit(self, X, y):
+        def fit(self, X, y=None):
             tfidf = TfidfVectorizer(analyzer=lambda x: x)
             tfidf.fit(X)
             # if a word was never seen - it must be at least as infrequent
@@ -1242,16 +2056,1025 @@ class Basket:
             self.word2weight = defaultdict(
                 lambda: max_idf,
                 [(w, tfidf.idf_[i]) for w, i in tfidf.vocabulary_.items()])
-
+            self.idf = np.empty(len(self.vocabulary), dtype=np.float32)
+            self.idf.fill(max_idf)
+            for w, i in tfidf.vocabulary_.iteritems():
+                if w in self.vocabulary:
+                    self.idf[self.vocabulary[w]] = tfidf.idf_[i]
             return self
 
-        def transform(self, X):
-            return np.array([
-                    np.mean([self.word2vec[w] * self.word2weight[w]
-                             for w in words if w in self.word2vec] or
-                            [np.zeros(self.dim)], axis=0)
-                    for words in X
-                ])
+        def count_matrix(self, X):
+            """ Returns the sparse (docs, vocabulary) matrix of the number of occurrences of the terms in X """
+            vocabulary = self.vocabulary
+            terms_idx = [[vocabulary[w] for w in words if w in vocabulary] for words in X]
+            lengths = np.array([len(t) for t in terms_idx], dtype=np.int64)
+            cols = np.fromiter((i for t in terms_idx for i in t), dtype=np.int32, count=lengths.sum())
+            rows = np.repeat(np.arange(len(terms_idx), dtype=np.int32), lengths)
+            return scipy.sparse.csr_matrix((np.ones(len(cols), dtype=np.float32), (rows, cols)),
+                                           shape=(len(terms_idx), len(vocabulary)))
+
+        def transform(self, X, weighted=True):
+            """ Returns the (docs, dim) embeddings, weighted=False for the plain mean of the terms vectors """
+            counts = self.count_matrix(X)
+            lengths = np.asarray(counts.sum(axis=1)).ravel()
+            if weighted:
+                counts = counts * scipy.sparse.diags(self.idf, 0)
+            embeddings = np.asarray(counts * self.embeddings)
+            embeddings /= np.maximum(lengths, 1)[:, None] # mean over the terms, zeros for documents without known terms
+            if self.norm is not None:
+                embeddings = preprocessing.normalize(embeddings, norm=self.norm)
+            return embeddings
+
+#_________________________________________________________________#
+#                      Basket index class                         #
+#_________________________________________________________________#
+class BasketIndex:
+    """
+    Indexes used by Basket.select(). They are built the first time they are needed:
+        inverted tag index and username index (value -> sorted array of positions in the basket),
+        taken from the TagIndex if the basket keeps one up to date (see Basket.enable_tag_index)
+        sorted numeric columns for duration and descriptor stats (sorted values, positions)
+    The basket drops its index when sounds are pushed or removed and when the tags are preprocessed
+    (tags_lower, text_preprocessing), call Basket.reindex() after changing the sounds directly (sound.tags = ...)
+    """
+    def __init__(self, basket):
+        self.basket = basket
+        self.nb_sounds = len(basket)
+        self._tags = None
+        self._usernames = None
+        self._numeric = {}
+
+    def select(self, tags=None, duration=None, username=None, descriptors=None):
+        """ Returns the sorted array of positions of the sounds matching all the conditions """
+        selections = []
+        if tags is not None:
+            tag_index = getattr(self.basket, 'tag_index', None)
+            postings = self.tags() if tag_index is None else None
+            for tag in ([tags] if isinstance(tags, basestring) else tags):
+                selections.append(tag_index.positions(tag) if tag_index is not None else postings.get(tag, np.zeros(0, dtype=np.int64)))
+        if username is not None:
+            postings = self.usernames()
+            usernames = [username] if isinstance(username, basestring) else username
+            selections.append(np.sort(np.concatenate([postings.get(u, np.zeros(0, dtype=np.int64)) for u in usernames])))
+        ranges = list((descriptors or {}).items())
+        if duration is not None:
+            ranges.insert(0, ('duration', duration))
+
+        if selections:
+            selections.sort(key=len)
+            positions = selections[0]
+            for selection in selections[1:]:
+                positions = np.intersect1d(positions, selection, assume_unique=True)
+        elif ranges:
+            positions = self.range(*ranges.pop(0))
+        else:
+            return np.arange(self.nb_sounds)
+        # the remaining ranges are checked on the (small) set of candidates
+        for column, value_range in ranges:
+            positions = positions[self._in_range(column, positions, value_range)]
+        return positions
+
+    def tags(self):
+        if self._tags is None and getattr(self.basket, 'tag_index', None) is not None:
+            self._tags = self.basket.tag_index.tags()
+        if self._tags is None:
+            self._tags = self._postings([sound.tags if sound is not None else [] for sound in self.basket.sounds])
+        return self._tags
+
+    def usernames(self):
+        if self._usernames is None:
+            self._usernames = self._postings([[getattr(sound, 'username', None)] if sound is not None else [] for sound in self.basket.sounds])
+        return self._usernames
+
+    @staticmethod
+    def _postings(values_per_sound):
+        """ Returns the inverted index {value: sorted array of the positions of the sounds having it} built in one pass """
+        postings = {}
+        for idx, values in enumerate(values_per_sound):
+            for value in values:
+                positions = postings.setdefault(value, [])
+                if not positions or positions[-1] != idx: # a value counted once per sound
+                    positions.append(idx)
+        return {value: np.array(positions, dtype=np.int64) for value, positions in postings.iteritems()}
+
+    def range(self, column, value_range):
+        """ Returns the sorted positions of the sounds which column value is in value_range (bounds included) """
+        values, positions, _ = self._column(column)
+        low, high = value_range
+        begin = np.searchsorted(values, low, side='left') if low is not None else 0
+        end = np.searchsorted(values, high, side='right') if high is not None else len(values)
+        return np.sort(positions[begin:end])
+
+    def _in_range(self, column, positions, value_range):
+        """ Returns the mask of the given positions which column value is in value_range """
+        values = self._column(column)[2][positions]
+        low, high = value_range
+        mask = ~np.isnan(values)
+        if low is not None:
+            mask &= values >= low
+        if high is not None:
+            mask &= values <= high
+        return mask
+
+    def _column(self, column):
+        """ Returns (sorted values, their positions, values by position) of a numeric column, nan for missing values """
+        if column not in self._numeric:
+            if column == 'duration':
+                values = [getattr(sound, 'duration', None) if sound is not None else None for sound in self.basket.sounds]
+            else:
+                values = [self._descriptor_value(stats, column) for stats in self.basket.analysis_stats]
+            values = np.array([v if v is not None else np.nan for v in values], dtype=np.float64)
+            positions = np.where(~np.isnan(values))[0]
+            order = np.argsort(values[positions], kind='mergesort')
+            self._numeric[column] = (values[positions][order], positions[order], values)
+        return self._numeric[column]
+
+    @staticmethod
+    def _descriptor_value(stats, descriptor):
+        value = stats
+        try:
+            for name in descriptor.split('.'):
+                value = value[int(name)] if name.isdigit() else getattr(value, name.replace('-', '_'))
+            return float(value)
+        except (AttributeError, IndexError, TypeError, ValueError):
+            return None
+
+
+#_________________________________________________________________#
+#                        Tag index class                          #
+#_________________________________________________________________#
+class TagIndex:
+    """
+    Inverted tag index of a Basket maintained incrementally when sounds are pushed, removed or their tags modified
+    (see Basket.enable_tag_index). Each sound has a row key, given in increasing order when it is pushed and
+    never changed, the postings hold row keys and the positions in the basket are found by a searchsorted
+    on the (sorted) keys of the sounds.
+    """
+    def __init__(self, sounds_tags=()):
+        self.keys = [] # row key of each sound in the basket
+        self._next_key = 0
+        self._row_tags = {} # row key -> tags of the sound
+        self._postings = {} # tag -> set of row keys
+        self._keys_array = None
+        for tags in sounds_tags:
+            self.add(tags)
+
+    def __len__(self):
+        return len(self.keys)
+
+    def add(self, tags):
+        """ Add a sound at the end of the basket """
+        key = self._next_key
+        self._next_key += 1
+        self.keys.append(key)
+        self._keys_array = None
+        self._index_row(key, tags)
+
+    def remove(self, positions):
+        """ Remove the sounds at the given positions """
+        for position in sorted(set(positions), reverse=True):
+            key = self.keys.pop(position)
+            self._unindex_row(key)
+        self._keys_array = None
+
+    def update(self, position, tags):
+        """ Replace the tags of the sound at position """
+        key = self.keys[position]
+        self._unindex_row(key)
+        self._index_row(key, tags)
+
+    def _index_row(self, key, tags):
+        tags = tuple(set(tags or ()))
+        self._row_tags[key] = tags
+        for tag in tags:
+            self._postings.setdefault(tag, set()).add(key)
+
+    def _unindex_row(self, key):
+        for tag in self._row_tags.pop(key):
+            postings = self._postings[tag]
+            postings.discard(key)
+            if not postings:
+                del self._postings[tag]
+
+    def count(self, tag):
+        """ Returns the number of sounds having the tag """
+        return len(self._postings.get(tag, ()))
+
+    def counts(self):
+        """ Returns a dict {tag: number of sounds} """
+        return {tag: len(keys) for tag, keys in self._postings.iteritems()}
+
+    def positions(self, tag):
+        """ Returns the sorted array of the positions of the sounds having the tag """
+        if self._keys_array is None:
+            self._keys_array = np.array(self.keys, dtype=np.int64)
+        keys = np.array(sorted(self._postings.get(tag, ())), dtype=np.int64)
+        return np.searchsorted(self._keys_array, keys)
+
+    def tags(self):
+        """ Returns the inverted index {tag: sorted array of positions}, like BasketIndex.tags() """
+        return {tag: self.positions(tag) for tag in self._postings}
+
+
+#_________________________________________________________________#
+#                      Basket store class                         #
+#_________________________________________________________________#
+class BasketStore:
+    """
+    Versioned binary container for a Basket (replaces the pickles for big baskets)
+    A store is a folder holding a header.json and one or several .npy files per column:
+        ids                 int64 array
+        duration            float64 array (nan when unknown)
+        name, username,
+        description, sounds utf-8 strings (bytes buffer + offsets), sounds holds the json of each sound
+        tags                tag vocabulary + int32 tag indexes (buffer + offsets)
+        analysis_stats      json of the analysis stats of each sound, and their matrix (see DescriptorSchema)
+        frames.<descriptor> frames (buffer + offsets + mask of present analysis)
+    Frames and stats matrix are written with settings.frames_dtype and settings.features_dtype (float32 by default).
+        clas                json list of labels (only if the basket has a clas attribute)
+    The arrays are loaded with memory mapping, so opening a store and reading some columns is fast.
+
+    >>> store = BasketStore('baskets_store/FreesoundDb')
+    >>> store.write(b)
+    >>> b = store.read(c, columns=['ids', 'tags'])
+    """
+    VERSION = 2
+    COLUMNS = ['ids', 'sounds', 'name', 'username', 'description', 'duration', 'tags', 'analysis_stats', 'clas']
+    STRING_COLUMNS = ['sounds', 'name', 'username', 'description', 'analysis_stats']
+
+    def __init__(self, path):
+        self.path = path
+        self._header = None
+        self._tags_vocabulary = None
+
+    def __len__(self):
+        return self.header['nb_sounds']
+
+    @property
+    def header(self):
+        if self._header is None:
+            with open(os.path.join(self.path, 'header.json')) as infile:
+                header = json.load(infile)
+            if header.get('version', 0) > self.VERSION:
+                raise ValueError('basket store version %s is not supported (max %s)' % (header.get('version'), self.VERSION))
+            self._header = header
+        return self._header
+
+    @property
+    def columns(self):
+        return self.COLUMNS + ['frames.' + d for d in self.header['analysis_names']]
+
+    # ____________________________ write ____________________________ #
+    def write(self, basket):
+        """
+        Write the basket in the store. The store is written in a temporary folder which replaces the old one at the end
+        """
+        tmp_path = self.path + '.tmp'
+        if os.path.exists(tmp_path):
+            shutil.rmtree(tmp_path)
+        os.makedirs(tmp_path)
+
+        nb_sounds = len(basket.ids)
+        sounds = basket.sounds + [None] * (nb_sounds - len(basket.sounds))
+        analysis_stats = basket.analysis_stats + [None] * (nb_sounds - len(basket.analysis_stats))
+
+        np.save(os.path.join(tmp_path, 'ids.npy'), np.array([i if i is not None else -1 for i in basket.ids], dtype=np.int64))
+        np.save(os.path.join(tmp_path, 'duration.npy'), np.array([getattr(s, 'duration', np.nan) if s is not None else np.nan for s in sounds], dtype=np.float64))
+        self._write_strings(tmp_path, 'sounds', [json.dumps(s.as_dict()) if s is not None else '' for s in sounds])
+        for field in ('name', 'username', 'description'):
+            self._write_strings(tmp_path, field, [getattr(s, field, '') or '' if s is not None else '' for s in sounds])
+        self._write_strings(tmp_path, 'analysis_stats', [json.dumps(self._as_dict(a)) if a is not None else '' for a in analysis_stats])
+        schema = DescriptorSchema.compile(analysis_stats)
+        if schema.width:
+            np.save(os.path.join(tmp_path, 'analysis_stats.matrix.npy'), schema.transform(analysis_stats))
+        self._write_tags(tmp_path, [s.tags if s is not None else [] for s in sounds])
+
+        frames_header = {}
+        for descriptor in basket.analysis_names:
+            frames_header[descriptor] = self._write_frames(tmp_path, descriptor, basket.analysis.rgetattr(descriptor))
+        if hasattr(basket, 'clas'):
+            with open(os.path.join(tmp_path, 'clas.json'), 'w') as outfile:
+                json.dump(list(basket.clas), outfile)
+
+        header = {'format': 'freesound-basket-store',
+                  'version': self.VERSION,
+                  'nb_sounds': nb_sounds,
+                  'analysis_names': list(basket.analysis_names),
+                  'frames': frames_header,
+                  'descriptor_schema': schema.to_json() if schema.width else None,
+                  'clas': hasattr(basket, 'clas')}
+        with open(os.path.join(tmp_path, 'header.json'), 'w') as outfile:
+            json.dump(header, outfile)
+
+        if os.path.exists(self.path):
+            shutil.rmtree(self.path)
+        os.rename(tmp_path, self.path)
+        self._header = None
+        self._tags_vocabulary = None
+
+    @staticmethod
+    def _as_dict(obj):
+        try:
+            return obj.as_dict()
+        except AttributeError: # some baskets hold features lists in analysis_stats
+            return list(obj)
+
+    @staticmethod
+    def _write_strings(path, name, strings):
+        encoded = [s.encode('utf-8') if isinstance(s, unicode) else s for s in strings]
+        offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        np.cumsum([len(s) for s in encoded], out=offsets[1:])
+        np.save(os.path.join(path, name + '.data.npy'), np.frombuffer(''.join(encoded), dtype=np.uint8))
+        np.save(os.path.join(path, name + '.offsets.npy'), offsets)
+
+    @staticmethod
+    def _write_tags(path, all_tags):
+        vocabulary = {}
+        tag_idx = []
+        offsets = np.zeros(len(all_tags) + 1, dtype=np.int64)
+        for idx, tags in enumerate(all_tags):
+            for tag in tags:
+                tag_idx.append(vocabulary.setdefault(tag, len(vocabulary)))
+            offsets[idx + 1] = len(tag_idx)
+        vocabulary = [t for t, _ in sorted(vocabulary.items(), key=operator.itemgetter(1))]
+        with open(os.path.join(path, 'tags.vocabulary.json'), 'w') as outfile:
+            json.dump(vocabulary, outfile)
+        np.save(os.path.join(path, 'tags.data.npy'), np.array(tag_idx, dtype=np.int32))
+        np.save(os.path.join(path, 'tags.offsets.npy'), offsets)
+
+    @staticmethod
+    def _write_frames(path, descriptor, all_frames):
+        if not isinstance(all_frames, RaggedFrames):
+            all_frames = RaggedFrames.from_list(all_frames)
+        elif all_frames.values.dtype != SettingsSingleton().frames_dtype:
+            all_frames = RaggedFrames(all_frames.values.astype(SettingsSingleton().frames_dtype), all_frames.offsets, all_frames.mask, all_frames.ndim)
+        np.save(os.path.join(path, 'frames.' + descriptor + '.data.npy'), all_frames.values)
+        np.save(os.path.join(path, 'frames.' + descriptor + '.offsets.npy'), all_frames.offsets)
+        np.save(os.path.join(path, 'frames.' + descriptor + '.mask.npy'), all_frames.mask)
+        return {'ndim': all_frames.ndim, 'width': all_frames.values.shape[1], 'dtype': all_frames.values.dtype.name}
+
+    # ____________________________ read _____________________________ #
+    def descriptor_schema(self):
+        """ Returns the DescriptorSchema of the stats matrix (None for old stores or baskets without stats) """
+        fields = self.header.get('descriptor_schema')
+        return DescriptorSchema.from_json(fields) if fields else None
+
+    def read_descriptor_stats(self, start=0, stop=None):
+        """ Returns the memory mapped stats matrix of the sounds in [start, stop[ (nan for missing values) """
+        return self.load_array('analysis_stats.matrix')[start:stop]
+
+    def update_hash(self, sha, files, block_size=2**24):
+        """ Update a hashlib object with the content of some files of the store, read by blocks """
+        for name in files:
+            with open(os.path.join(self.path, name), 'rb') as infile:
+                for block in iter(lambda: infile.read(block_size), ''):
+                    sha.update(block)
+            sha.update('\x02')
+
+    def load_array(self, name):
+        """ Returns the memory mapped array stored in <name>.npy """
+        return np.load(os.path.join(self.path, name + '.npy'), mmap_mode='r')
+
+    def read_strings(self, name, start=0, stop=None):
+        offsets = np.asarray(self.load_array(name + '.offsets')[start:(stop if stop is None else stop + 1)])
+        data = self.load_array(name + '.data')[offsets[0]:offsets[-1]].tostring()
+        offsets = offsets - offsets[0]
+        return [data[offsets[i]:offsets[i+1]].decode('utf-8') for i in range(len(offsets) - 1)]
+
+    def read_tags(self, start=0, stop=None):
+        if self._tags_vocabulary is None:
+            with open(os.path.join(self.path, 'tags.vocabulary.json')) as infile:
+                self._tags_vocabulary = json.load(infile)
+        vocabulary = self._tags_vocabulary
+        offsets = np.asarray(self.load_array('tags.offsets')[start:(stop if stop is None else stop + 1)])
+        tag_idx = np.asarray(self.load_array('tags.data')[offsets[0]:offsets[-1]])
+        offsets = offsets - offsets[0]
+        return [[vocabulary[t] for t in tag_idx[offsets[i]:offsets[i+1]]] for i in range(len(offsets) - 1)]
+
+    def read_frames(self, descriptor, start=0, stop=None):
+        """ Returns the RaggedFrames of a descriptor, its buffer is memory mapped """
+        info = self.header['frames'][descriptor]
+        offsets = np.asarray(self.load_array('frames.' + descriptor + '.offsets')[start:(stop if stop is None else stop + 1)])
+        values = self.load_array('frames.' + descriptor + '.data')[offsets[0]:offsets[-1]]
+        mask = np.asarray(self.load_array('frames.' + descriptor + '.mask')[start:stop])
+        return RaggedFrames(values, offsets - offsets[0], mask, info['ndim'])
+
+    def open(self, client):
+        """
+        Returns a Basket holding only the ids, backed by the store.
+        Its sounds are not loaded, use Basket.iter_chunks() to stream them from the disk
+        """
+        basket = Basket(client)
+        basket.ids = [int(i) if i >= 0 else None for i in self.load_array('ids')]
+        basket.store = self
+        return basket
+
+    def read(self, client, columns=None, start=0, stop=None):
+        """
+        Returns a Basket with the given columns loaded (all by default) for the sounds in [start, stop[
+        Sounds are created from the json of the sounds if the 'sounds' column is loaded,
+        otherwise they only hold the loaded metadata columns (id, name, tags, ...)
+        """
+        columns = self._expand_columns(columns)
+        stop = min(len(self), stop if stop is not None else len(self))
+        basket = Basket(client)
+        basket.ids = [int(i) if i >= 0 else None for i in self.load_array('ids')[start:stop]]
+        nb_sounds = len(basket.ids)
+
+        if 'sounds' in columns:
+            basket.sounds = [freesound.Sound(simplejson.loads(s), client) if s else None for s in self.read_strings('sounds', start, stop)]
+        else:
+            fields = {'id': basket.ids}
+            for field in ('name', 'username', 'description'):
+                if field in columns:
+                    fields[field] = self.read_strings(field, start, stop)
+            if 'duration' in columns:
+                fields['duration'] = [float(d) for d in self.load_array('duration')[start:stop]]
+            if 'tags' in columns:
+                fields['tags'] = self.read_tags(start, stop)
+            basket.sounds = [freesound.Sound({k: v[i] for k, v in fields.iteritems()}, client) if basket.ids[i] is not None else None for i in range(nb_sounds)]
+
+        if 'analysis_stats' in columns:
+            basket.analysis_stats = [self._from_dict(simplejson.loads(a), client) if a else None for a in self.read_strings('analysis_stats', start, stop)]
+            basket._schema = self.descriptor_schema()
+        else:
+            basket.analysis_stats = [None] * nb_sounds
+
+        for descriptor in self.header['analysis_names']:
+            if 'frames.' + descriptor in columns:
+                basket.analysis.rsetattr(descriptor, self.read_frames(descriptor, start, stop))
+                basket.analysis_names.append(descriptor)
+
+        if 'clas' in columns and self.header['clas']:
+            with open(os.path.join(self.path, 'clas.json')) as infile:
+                basket.clas = json.load(infile)[start:stop]
+        return basket
+
+    def iter_chunks(self, client, size, columns=None):
+        """ Yields Baskets of at most size sounds, read one after the other from the store """
+        for start in range(0, len(self), size):
+            yield self.read(client, columns, start, start + size)
+
+    def _expand_columns(self, columns):
+        if columns is None:
+            return set(self.columns)
+        columns = set(columns)
+        if 'frames' in columns:
+            columns.update('frames.' + d for d in self.header['analysis_names'])
+        return columns
+
+    @staticmethod
+    def _from_dict(d, client):
+        if isinstance(d, dict):
+            return freesound.FreesoundObject(d, client)
+        return d
+
+
+#_________________________________________________________________#
+#                    Text preprocessing class                     #
+#_________________________________________________________________#
+class TextPreprocessor:
+    """
+    Preprocessing of tags and descriptions used by the Basket preprocessing methods.
+    Regexes are compiled once, stop words are in a set and the stems are memoised (token -> stem).
+    map() distributes the sounds by chunks in a pool of processes when there are many.
+    >>> p = TextPreprocessor.shared()
+    >>> p.tag_description_terms(sound.tags, sound.description)
+    >>> p.map('tag_description_terms', [(s.tags, s.description) for s in b.sounds])
+    """
+    TOKEN_PATTERN = re.compile(r'(?u)\b\w\w+\b') # same tokens as CountVectorizer().build_tokenizer()
+    LINK_PATTERN = re.compile('<a href(.)+/a>')
+    SENTENCE_LINK_PATTERN = re.compile('<a href(.)+>')
+    SENTENCE_DELIMITERS = re.compile('|'.join(map(re.escape, ('.', '?', '!', ':'))))
+    SENTENCE_SPACES = re.compile(r'\r\n|[()]')
+    SENTENCE_REMOVED = re.compile('[*\-#,/]')
+    VERSION = 1 # change it when the preprocessing changes, it invalidates the CorpusCache
+    _shared = None
+
+    def __init__(self, stop_words=None):
+        self.stop_words = frozenset(stop_words if stop_words is not None else get_stop_words('en') + ['freesound', 'org'])
+        self._stemmer = PorterStemmer()
+        self._stems = {}
+
+    @classmethod
+    def shared(cls):
+        """ Returns the preprocessor of the process, its stem cache is kept between calls """
+        if cls._shared is None:
+            cls._shared = cls()
+        return cls._shared
+
+    def stem(self, token):
+        try:
+            return self._stems[token]
+        except KeyError:
+            stem = self._stems[token] = self._stemmer.stem(token)
+            return stem
+
+    def description_terms(self, description):
+        """ Lower case, remove links, tokenization, remove stop words, stemming """
+        description = self.LINK_PATTERN.sub(' ', (description or '').lower())
+        stop_words = self.stop_words
+        return [self.stem(word) for word in self.TOKEN_PATTERN.findall(description) if word not in stop_words]
+
+    def tag_terms(self, tags):
+        """ Lower case, stemming """
+        return [self.stem(tag.lower()) for tag in tags or []]
+
+    def tag_description_terms(self, tags, description):
+        return self.tag_terms(tags) + self.description_terms(description)
+
+    def sentences(self, description):
+        """ Returns the list of stemmed terms of each sentence of a description (see Basket.get_preprocessed_descriptions_word2vec) """
+        string = self.SENTENCE_SPACES.sub(' ', (description or '').lower())
+        string = self.SENTENCE_REMOVED.sub('', string)
+        string = self.SENTENCE_LINK_PATTERN.sub(' ', string)
+        return [[self.stem(a) for a in sentence.split()] for sentence in self.SENTENCE_DELIMITERS.split(string) if sentence]
+
+    def params(self):
+        """ Returns the parameters of the preprocessing, used in the CorpusCache keys """
+        return {'version': self.VERSION, 'stop_words': sorted(self.stop_words)}
+
+    def map(self, method, items, processes=None, chunk_size=1000):
+        """
+        Returns [getattr(self, method)(*item) for item in items], computed in a pool of processes
+        (one per core by default) when there are more than PARALLEL_MIN_SOUNDS items
+        """
+        items = list(items)
+        if len(items) < PARALLEL_MIN_SOUNDS or processes == 1:
+            function = getattr(self, method)
+            return [function(*item) for item in items]
+        tasks = [(method, items[start:start + chunk_size]) for start in range(0, len(items), chunk_size)]
+        pool = multiprocessing.Pool(processes or multiprocessing.cpu_count())
+        try:
+            return flat_list(pool.map(_preprocess_chunk, tasks))
+        finally:
+            pool.terminate()
+
+
+#_________________________________________________________________#
+#                       Corpus cache class                        #
+#_________________________________________________________________#
+class CorpusCache:
+    """
+    On-disk cache of preprocessed corpora (list of terms for each sound), in corpus_cache/<key>/:
+        header.json         preprocessing method, parameters and number of documents
+        vocabulary.json     list of the terms
+        tokens.npy          int32 term ids of all the documents concatenated
+        offsets.npy         int64 offsets of the documents in tokens
+    The key is a hash of the sound ids, their tags and descriptions and of the preprocessing parameters,
+    so a cached corpus is not used any more when the basket or the preprocessing change.
+    For a basket opened from a store (no loaded sounds) the ids, tags and description files of the store are hashed.
+    >>> cache = CorpusCache()
+    >>> key = cache.key(b, 'tag_description_terms', TextPreprocessor.shared().params())
+    >>> docs = cache.get(key)
+    """
+    def __init__(self, path='corpus_cache'):
+        self.path = path
+
+    @staticmethod
+    def key(basket, method, params):
+        import hashlib
+        sha = hashlib.sha1()
+        sha.update(json.dumps([method, params], sort_keys=True))
+        if basket.store is not None and not basket.sounds:
+            basket.store.update_hash(sha, ['ids.npy', 'tags.vocabulary.json', 'tags.data.npy', 'tags.offsets.npy',
+                                           'description.data.npy', 'description.offsets.npy'])
+            return sha.hexdigest()
+        sha.update(np.array([i if i is not None else -1 for i in basket.ids], dtype=np.int64).tostring())
+        for sound in basket.sounds:
+            if sound is not None:
+                sha.update(u'\x00'.join(sound.tags or []).encode('utf-8'))
+                sha.update('\x01')
+                sha.update((getattr(sound, 'description', None) or u'').encode('utf-8'))
+            sha.update('\x02')
+        return sha.hexdigest()
+
+    def exists(self, key):
+        return os.path.exists(os.path.join(self.path, key, 'header.json'))
+
+    def get(self, key):
+        """ Returns the cached list of terms of each document, None if not in the cache """
+        arrays = self.get_arrays(key)
+        if arrays is None:
+            return None
+        tokens, offsets, vocabulary = arrays
+        tokens = np.asarray(tokens).tolist()
+        return [[vocabulary[t] for t in tokens[offsets[i]:offsets[i+1]]] for i in range(len(offsets) - 1)]
+
+    def get_arrays(self, key):
+        """ Returns the memory mapped (tokens, offsets, vocabulary) of a cached corpus, None if not in the cache """
+        if not self.exists(key):
+            return None
+        path = os.path.join(self.path, key)
+        with open(os.path.join(path, 'vocabulary.json')) as infile:
+            vocabulary = json.load(infile)
+        tokens = np.load(os.path.join(path, 'tokens.npy'), mmap_mode='r')
+        offsets = np.load(os.path.join(path, 'offsets.npy')).tolist()
+        return tokens, offsets, vocabulary
+
+    def put(self, key, documents, method=None, params=None):
+        """ Save the documents (list of lists of terms) in the cache """
+        self.put_chunks(key, [documents], method, params)
+
+    def put_chunks(self, key, chunks, method=None, params=None, block_size=2**22):
+        """ Save the documents given by chunks (iterable of lists of lists of terms), only one chunk is in memory at a time """
+        vocabulary = {}
+        offsets = [0]
+        path = os.path.join(self.path, key)
+        tmp_path = path + '.tmp'
+        if os.path.exists(tmp_path):
+            shutil.rmtree(tmp_path)
+        os.makedirs(tmp_path)
+        with open(os.path.join(tmp_path, 'tokens.bin'), 'wb') as outfile:
+            for documents in chunks:
+                tokens = []
+                for document in documents:
+                    tokens.extend(vocabulary.setdefault(term, len(vocabulary)) for term in document)
+                    offsets.append(offsets[-1] + len(document))
+                np.array(tokens, dtype=np.int32).tofile(outfile)
+        # copy the raw tokens in a .npy file by blocks
+        raw_tokens = np.memmap(os.path.join(tmp_path, 'tokens.bin'), dtype=np.int32, mode='r') if offsets[-1] else np.zeros(0, np.int32)
+        tokens = np.lib.format.open_memmap(os.path.join(tmp_path, 'tokens.npy'), mode='w+', dtype=np.int32, shape=(offsets[-1],))
+        for start in range(0, offsets[-1], block_size):
+            tokens[start:start+block_size] = raw_tokens[start:start+block_size]
+        tokens.flush()
+        del tokens, raw_tokens
+        os.remove(os.path.join(tmp_path, 'tokens.bin'))
+        np.save(os.path.join(tmp_path, 'offsets.npy'), np.array(offsets, dtype=np.int64))
+        with open(os.path.join(tmp_path, 'vocabulary.json'), 'w') as outfile:
+            json.dump(sorted(vocabulary, key=vocabulary.get), outfile)
+        with open(os.path.join(tmp_path, 'header.json'), 'w') as outfile: # written last, marks a complete corpus
+            json.dump({'method': method, 'params': params, 'nb_documents': len(offsets) - 1}, outfile)
+        if os.path.exists(path):
+            shutil.rmtree(path)
+        os.rename(tmp_path, path)
+
+    def clear(self):
+        """ Remove all the cached corpora """
+        for name in os.listdir(self.path):
+            shutil.rmtree(os.path.join(self.path, name))
+
+
+class StreamingCorpus:
+    """
+    Restartable iterable over a corpus saved in the CorpusCache, for the gensim trainings which go through it several times.
+    The token ids are read from the memory mapped tokens.npy by chunks of chunk_size documents and converted to terms,
+    so that the memory used does not depend on the size of the corpus.
+    tagged=True yields TaggedDocuments tagged with the position of the document (for doc2vec)
+    >>> corpus = b.streaming_corpus()
+    >>> for terms in corpus:
+    ...     print terms
+    """
+    def __init__(self, path, chunk_size=10000, tagged=False):
+        self.path = path
+        self.chunk_size = chunk_size
+        self.tagged = tagged
+        with open(os.path.join(path, 'header.json')) as infile:
+            self.nb_documents = json.load(infile)['nb_documents']
+
+    def __len__(self):
+        return self.nb_documents
+
+    def __iter__(self):
+        from gensim.models.doc2vec import TaggedDocument
+        with open(os.path.join(self.path, 'vocabulary.json')) as infile:
+            vocabulary = json.load(infile)
+        tokens = np.load(os.path.join(self.path, 'tokens.npy'), mmap_mode='r')
+        offsets = np.load(os.path.join(self.path, 'offsets.npy'), mmap_mode='r')
+        for start in range(0, self.nb_documents, self.chunk_size):
+            chunk_offsets = offsets[start:start+self.chunk_size+1].tolist()
+            chunk_tokens = tokens[chunk_offsets[0]:chunk_offsets[-1]].tolist()
+            for i in range(len(chunk_offsets) - 1):
+                terms = [vocabulary[t] for t in chunk_tokens[chunk_offsets[i]-chunk_offsets[0]:chunk_offsets[i+1]-chunk_offsets[0]]]
+                yield TaggedDocument(terms, [start + i]) if self.tagged else terms
+
+
+#_________________________________________________________________#
+#                      Similarity functions                       #
+#_________________________________________________________________#
+_similarity_operands = None # (normalised rows, normalised columns matrix transposed, k, threshold, exclude_self) shared with the pool workers
+
+def top_k_cosine_similarity(matrix, other=None, k=None, threshold=None, exclude_self=False,
+                            memory_budget=256, processes=1):
+    """
+    Returns the sparse (csr, float32) cosine similarity matrix between the rows of matrix and the rows of other
+    (matrix by default), keeping for each row only the k most similar entries and/or the ones >= threshold.
+    Rows are normalised once, the product is done by blocks of rows which dense similarities fit in
+    memory_budget MB, in a pool of processes if processes > 1 (None for one per core).
+    Works with sparse or dense features.
+    >>> sim = top_k_cosine_similarity(nlp.sound_tag_matrix, k=20)
+    >>> sim = top_k_cosine_similarity(nlp.sound_tag_matrix.T, threshold=0.5, exclude_self=True) # tag/tag
+    """
+    global _similarity_operands
+    rows = preprocessing.normalize(as_features(matrix, np.float32), norm='l2')
+    columns = rows if other is None else preprocessing.normalize(as_features(other, np.float32), norm='l2')
+    columns = columns.T.tocsc() if scipy.sparse.issparse(columns) else np.ascontiguousarray(columns.T)
+    nb_rows, nb_columns = rows.shape[0], columns.shape[1]
+    block_size = max(1, int(memory_budget * 2 ** 20 / (nb_columns * 4 * 3))) # product, copy and argpartition indexes
+    starts = range(0, nb_rows, block_size)
+    _similarity_operands = (rows, columns, k, threshold, exclude_self and other is None)
+    pool = None
+    try:
+        tasks = [(start, min(start + block_size, nb_rows)) for start in starts]
+        if processes == 1 or len(tasks) < 2:
+            results = (_top_k_block(task) for task in tasks)
+        else:
+            pool = multiprocessing.Pool(processes or multiprocessing.cpu_count())
+            results = pool.imap(_top_k_block, tasks)
+        block_rows, block_cols, block_data = [], [], []
+        for r, c, d in results:
+            block_rows.append(r)
+            block_cols.append(c)
+            block_data.append(d)
+    finally:
+        _similarity_operands = None
+        if pool is not None:
+            pool.terminate()
+    if not block_rows:
+        return scipy.sparse.csr_matrix((nb_rows, nb_columns), dtype=np.float32)
+    return scipy.sparse.csr_matrix((np.concatenate(block_data), (np.concatenate(block_rows), np.concatenate(block_cols))),
+                                   shape=(nb_rows, nb_columns), dtype=np.float32)
+
+def knn_indices(similarity_matrix, k, block_size=1000):
+    """
+    Returns the (nb rows, k) arrays (indices, scores) of the k most similar columns of each row of a similarity
+    matrix (dense or sparse), sorted by decreasing similarity. Rows are processed by blocks with argpartition.
+    For feature matrices, see top_k_cosine_similarity.
+    >>> indices, scores = knn_indices(similarity_matrix, 20)
+    """
+    nb_rows, nb_columns = similarity_matrix.shape
+    k = min(k, nb_columns)
+    indices = np.empty((nb_rows, k), dtype=np.int64)
+    scores = np.empty((nb_rows, k), dtype=np.float64)
+    for start in range(0, nb_rows, block_size):
+        block = similarity_matrix[start:start + block_size]
+        block = np.asarray(block.todense() if scipy.sparse.issparse(block) else block)
+        if block.dtype != np.float32:
+            block = block.astype(np.float64)
+        rows = np.arange(len(block))[:, None]
+        top = np.argpartition(-block, k - 1, axis=1)[:, :k] if k < nb_columns else np.tile(np.arange(nb_columns), (len(block), 1))
+        order = np.argsort(-block[rows, top], axis=1, kind='mergesort')
+        indices[start:start + len(block)] = top[rows, order]
+        scores[start:start + len(block)] = block[rows, indices[start:start + len(block)]]
+    return indices, scores
+
+_knn_operands = None # operands of Nlp.compute_knn_similarities shared with the pool workers
+
+def _knn_block(start):
+    """ Pool worker of Nlp.compute_knn_similarities(): compute and save the k nearest neighbours of a block of rows """
+    rows, columns, ids, k, block_size, path = _knn_operands
+    block = rows[start:start + block_size].dot(columns)
+    indices, scores = knn_indices(block, k, block_size=100) # bounds the argpartition temporaries
+    out_path = Nlp._knn_block_path(path, start)
+    tmp_path = out_path[:-len('.npz')] + '.tmp.npz'
+    np.savez(tmp_path, ids=ids[start:start + block_size], neighbours=ids[indices].astype(np.int32), scores=scores.astype(np.float32))
+    os.rename(tmp_path, out_path)
+    return start
+
+def _top_k_block(task):
+    """ Returns (rows, columns, similarities) kept for the rows in [start, stop[ (see top_k_cosine_similarity) """
+    start, stop = task
+    rows, columns, k, threshold, exclude_self = _similarity_operands
+    block = rows[start:stop].dot(columns)
+    block = np.asarray(block.todense() if scipy.sparse.issparse(block) else block, dtype=np.float32)
+    if exclude_self:
+        block[np.arange(stop - start), np.arange(start, stop)] = -np.inf
+    if k is not None and k < block.shape[1]:
+        cols = np.argpartition(-block, k - 1, axis=1)[:, :k]
+        rows_idx = np.repeat(np.arange(stop - start), k).reshape(-1, k)
+        values = block[rows_idx, cols]
+    else:
+        cols = np.tile(np.arange(block.shape[1]), (stop - start, 1))
+        rows_idx = np.repeat(np.arange(stop - start), block.shape[1]).reshape(-1, block.shape[1])
+        values = block
+    keep = values != 0
+    keep &= np.isfinite(values)
+    if threshold is not None:
+        keep &= values >= threshold
+    return (rows_idx[keep] + start).astype(np.int32), cols[keep].astype(np.int32), values[keep]
+
+
+def write_louvain_graph(adjacency, path, ids=None, weighted=True, binary=True):
+    """
+    Write the graph of a (nb nodes, nb nodes) scipy sparse adjacency matrix for the C++ Louvain tools:
+    binary=True  : the binary graph written by their 'convert' program (the graph is made undirected like convert does)
+                   path            int32 nb nodes, int64 cumulative degrees, int32 links
+                   path.weights    float32 weights of the links (if weighted)
+    binary=False : the text edge list 'idx neighbour_idx [weight]' given to 'convert'
+    The nodes are the contiguous indexes of the matrix, if given ids (eg freesound ids of the nodes) are saved in path.ids.npy
+    >>> adjacency, fs_ids = nlp.create_sparse_graph_from_nearest(k_nn=100)
+    >>> write_louvain_graph(adjacency, 'graph.bin', fs_ids)
+    """
+    adjacency = scipy.sparse.coo_matrix(adjacency)
+    buffering = 2 ** 24
+    if binary:
+        loops = adjacency.row == adjacency.col # links in both directions, loops only once
+        rows = np.concatenate((adjacency.row, adjacency.col[~loops]))
+        cols = np.concatenate((adjacency.col, adjacency.row[~loops]))
+        data = np.concatenate((adjacency.data, adjacency.data[~loops])).astype(np.float32)
+        graph = scipy.sparse.csr_matrix((data, (rows, cols)), shape=adjacency.shape)
+        graph.sum_duplicates()
+        with open(path, 'wb', buffering) as f:
+            np.array([graph.shape[0]], dtype=np.int32).tofile(f)
+            graph.indptr[1:].astype(np.int64).tofile(f)
+            graph.indices.astype(np.int32).tofile(f)
+        if weighted:
+            with open(path + '.weights', 'wb', buffering) as f:
+                graph.data.astype(np.float32).tofile(f)
+    else:
+        columns = (adjacency.row, adjacency.col, adjacency.data) if weighted else (adjacency.row, adjacency.col)
+        line = '%d %d %.9g\n' if weighted else '%d %d\n'
+        chunk = 100000
+        with open(path, 'w', buffering) as f:
+            for start in range(0, adjacency.nnz, chunk):
+                # one string formatting for all the lines of a chunk (faster than np.savetxt)
+                values = np.empty(len(columns) * len(columns[0][start:start + chunk]), dtype=object)
+                for i, column in enumerate(columns):
+                    values[i::len(columns)] = column[start:start + chunk].tolist()
+                f.write((line * (len(values) // len(columns))) % tuple(values))
+    if ids is not None:
+        np.save(path + '.ids.npy', np.asarray(ids, dtype=np.int64))
+
+
+#_________________________________________________________________#
+#                 Nearest neighbours index class                  #
+#_________________________________________________________________#
+class LshIndex:
+    """
+    Approximate nearest neighbours index of feature vectors (text or acoustic features, dense or sparse),
+    with random projection LSH: each of the n_tables hash tables puts the vectors in buckets given by the
+    signs of n_bits random projections. The candidates of a query are the vectors sharing one of its buckets
+    (plus the buckets obtained by flipping its probes least confident bits in each table), they are ranked
+    with the exact cosine similarity (or euclidean distance for metric='euclidean', use centered features
+    like extract_descriptor_stats(scale=True)).
+    Recall goes up with n_tables and probes, queries get faster with n_bits (smaller buckets).
+    >>> index = LshIndex(b.extract_descriptor_stats(scale=True), ids=b.ids, metric='euclidean')
+    >>> index.add(new_features, new_ids)
+    >>> indices, distances = index.query(features[:100], k=20, probes=4)
+    >>> adjacency = index.knn_graph(k=20)
+    >>> index.save('lsh_acoustic.npz')
+    >>> index = LshIndex.load('lsh_acoustic.npz')
+    """
+    def __init__(self, features, ids=None, n_tables=8, n_bits=12, metric='cosine', seed=0):
+        if metric not in ('cosine', 'euclidean'):
+            raise ValueError('unknown metric %s' % metric)
+        self.metric = metric
+        self.n_tables = n_tables
+        self.n_bits = n_bits
+        self.planes = np.random.RandomState(seed).randn(features.shape[1], n_tables * n_bits).astype(np.float32)
+        self.vectors = None
+        self.squared_norms = np.zeros(0, dtype=np.float32)
+        self.ids = np.zeros(0, dtype=np.int64)
+        self.codes = np.zeros((0, n_tables), dtype=np.int64)
+        self._tables = None # (order, sorted codes) of each table, sorted again after add
+        self.add(features, ids)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def _prepare(self, features):
+        features = as_features(features, np.float32)
+        if self.metric == 'cosine' and features.shape[0]:
+            features = preprocessing.normalize(features, norm='l2')
+        return features
+
+    def _hash(self, vectors):
+        """ Returns the (nb vectors, n_tables) codes and the (nb vectors, n_tables, n_bits) projections """
+        projections = np.asarray(vectors.dot(self.planes)).reshape(-1, self.n_tables, self.n_bits)
+        codes = ((projections > 0) * (np.int64(1) << np.arange(self.n_bits, dtype=np.int64))).sum(axis=2)
+        return codes, projections
+
+    def add(self, features, ids=None):
+        """ Add the feature vectors of new sounds (ids default to their positions in the index) """
+        vectors = self._prepare(features)
+        if ids is None:
+            ids = np.arange(len(self), len(self) + vectors.shape[0])
+        codes, _ = self._hash(vectors)
+        if self.vectors is None:
+            self.vectors = vectors
+        elif scipy.sparse.issparse(vectors):
+            self.vectors = scipy.sparse.vstack((self.vectors, vectors), format='csr')
+        else:
+            self.vectors = np.vstack((self.vectors, vectors))
+        squared_norms = vectors.multiply(vectors).sum(axis=1) if scipy.sparse.issparse(vectors) else (vectors ** 2).sum(axis=1)
+        self.squared_norms = np.concatenate((self.squared_norms, np.asarray(squared_norms, dtype=np.float32).ravel()))
+        self.ids = np.concatenate((self.ids, np.asarray(ids, dtype=np.int64)))
+        self.codes = np.vstack((self.codes, codes))
+        self._tables = None
+
+    def _sorted_tables(self):
+        if self._tables is None:
+            self._tables = []
+            for t in range(self.n_tables):
+                order = np.argsort(self.codes[:, t], kind='mergesort')
+                self._tables.append((order, self.codes[order, t]))
+        return self._tables
+
+    def query(self, features, k=10, probes=0, block_size=1000):
+        """
+        Returns the (nb queries, k) positions in the index of the approximate k nearest neighbours of the features
+        and their cosine similarities (euclidean distances), best first. Missing neighbours are -1 (nan).
+        Use self.ids[positions] for the sound ids.
+        """
+        queries = self._prepare(features)
+        results = [self._query_block(queries[start:start+block_size], k, probes)
+                   for start in range(0, queries.shape[0], block_size)]
+        if not results:
+            return np.zeros((0, k), dtype=np.int64), np.zeros((0, k), dtype=np.float32)
+        return np.vstack([r[0] for r in results]), np.vstack([r[1] for r in results])
+
+    def knn_graph(self, k=10, probes=0, block_size=1000):
+        """
+        Returns the (nb vectors, nb vectors) sparse csr knn graph of the index, weighted by the cosine similarities
+        (1 - distance / max distance for metric='euclidean', like Cluster.create_similarity_matrix_acoustic).
+        Each vector is only compared to its candidates, see write_louvain_graph for the Louvain tools.
+        """
+        rows, cols, data = [], [], []
+        Bar = ProgressBar(len(self), LENGTH_BAR, 'Building knn graph')
+        Bar.update(0)
+        for start in range(0, len(self), block_size):
+            positions = np.arange(start, min(start + block_size, len(self)))
+            indices, scores = self._query_block(self.vectors[positions], k, probes, positions)
+            found = indices >= 0
+            rows.append(np.repeat(positions, found.sum(axis=1)))
+            cols.append(indices[found])
+            data.append(scores[found])
+            Bar.update(positions[-1] + 1)
+        rows, cols, data = [np.concatenate(a) if a else np.zeros(0) for a in (rows, cols, data)]
+        if self.metric == 'euclidean' and len(data):
+            data = 1 - data / max(data.max(), np.finfo(np.float32).tiny)
+        return scipy.sparse.csr_matrix((data.astype(np.float32), (rows, cols)), shape=(len(self), len(self)))
+
+    def _query_block(self, queries, k, probes, positions=None):
+        """ Search a block of prepared queries, positions: their own positions in the index, excluded from the results """
+        nb_queries = queries.shape[0]
+        codes, projections = self._hash(queries)
+        codes = codes[:, :, None]
+        if probes:
+            flipped = np.argsort(np.abs(projections), axis=2)[:, :, :probes]
+            codes = np.concatenate((codes, codes ^ (np.int64(1) << flipped)), axis=2)
+        # candidates: (query, position) pairs of all the probed buckets
+        pairs = []
+        for t, (order, sorted_codes) in enumerate(self._sorted_tables()):
+            lo = np.searchsorted(sorted_codes, codes[:, t, :]).ravel()
+            lengths = np.searchsorted(sorted_codes, codes[:, t, :], side='right').ravel() - lo
+            offsets = np.arange(lengths.sum()) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+            query_idx = np.repeat(np.arange(nb_queries).repeat(codes.shape[2]), lengths)
+            pairs.append(query_idx * np.int64(len(self)) + order[np.repeat(lo, lengths) + offsets])
+        pairs = np.unique(np.concatenate(pairs))
+        query_idx, candidates = pairs // len(self), pairs % len(self)
+        if positions is not None:
+            keep = candidates != positions[query_idx]
+            query_idx, candidates = query_idx[keep], candidates[keep]
+        if scipy.sparse.issparse(self.vectors):
+            dots = np.asarray(self.vectors[candidates].multiply(queries[query_idx]).sum(axis=1)).ravel()
+        else:
+            dots = np.einsum('ij,ij->i', self.vectors[candidates], queries[query_idx])
+        if self.metric == 'cosine':
+            scores = dots
+        else:
+            query_norms = queries.multiply(queries).sum(axis=1) if scipy.sparse.issparse(queries) else (queries ** 2).sum(axis=1)
+            query_norms = np.asarray(query_norms, dtype=np.float32).ravel()
+            scores = np.sqrt(np.maximum(query_norms[query_idx] + self.squared_norms[candidates] - 2 * dots, 0))
+        # k best candidates of each query
+        best = np.lexsort((-scores if self.metric == 'cosine' else scores, query_idx))
+        query_idx, candidates, scores = query_idx[best], candidates[best], scores[best]
+        counts = np.bincount(query_idx, minlength=nb_queries)
+        ranks = np.arange(len(query_idx)) - np.repeat(np.cumsum(counts) - counts, counts)
+        keep = ranks < k
+        indices = np.full((nb_queries, k), -1, dtype=np.int64)
+        similarities = np.full((nb_queries, k), np.nan, dtype=np.float32)
+        indices[query_idx[keep], ranks[keep]] = candidates[keep]
+        similarities[query_idx[keep], ranks[keep]] = scores[keep]
+        return indices, similarities
+
+    def save(self, path):
+        """ Save the index in a .npz file """
+        arrays = {'planes': self.planes, 'codes': self.codes, 'ids': self.ids, 'squared_norms': self.squared_norms,
+                  'params': np.array([self.n_tables, self.n_bits]), 'metric': np.array(self.metric)}
+        if scipy.sparse.issparse(self.vectors):
+            arrays.update(vectors_data=self.vectors.data, vectors_indices=self.vectors.indices,
+                          vectors_indptr=self.vectors.indptr, vectors_shape=np.array(self.vectors.shape))
+        else:
+            arrays['vectors'] = self.vectors
+        np.savez(path, **arrays)
+
+    @staticmethod
+    def load(path):
+        arrays = np.load(path)
+        n_tables, n_bits = arrays['params'].tolist()
+        index = LshIndex(np.zeros((0, arrays['planes'].shape[0]), dtype=np.float32), None, n_tables, n_bits, str(arrays['metric']))
+        index.planes = arrays['planes']
+        if 'vectors' in arrays.files:
+            index.vectors = arrays['vectors']
+        else:
+            index.vectors = scipy.sparse.csr_matrix((arrays['vectors_data'], arrays['vectors_indices'], arrays['vectors_indptr']),
+                                                    shape=tuple(arrays['vectors_shape']))
+        index.codes = arrays['codes']
+        index.ids = arrays['ids']
+        index.squared_norms = arrays['squared_norms']
+        return index
+
 
 #_________________________________________________________________#
 #                           NLP class                             #
@@ -1278,59 +3101,76 @@ class Nlp:
             inverted_tag_index[tag] = idx
         return inverted_tag_index   
     
-    def create_sound_tag_matrix(self):
+    def create_sound_tag_matrix(self, dtype=np.int8, weighting=None, k1=1.2, b=0.75):
         """
-        Returns scipy sparse matrix sound id / tag (2d array) - lil_matrix 
+        Returns scipy sparse matrix sound id / tag (2d array) - csr_matrix
         Sounds are ordered like in the Basket (=self object)
         Tags are ordered like in the tags_occurrences list
-        """
-        Bar = ProgressBar(self.nb_sound, LENGTH_BAR, 'Creating matrix...')
-        Bar.update(0)
-        self.sound_tag_matrix = scipy.sparse.lil_matrix((self.nb_sound,self.nb_tag), dtype=int)
-        for idx_sound, tags in enumerate(self.sound_tags):
-            Bar.update(idx_sound+1)
-            for tag in tags:
-                try:
-                    self.sound_tag_matrix[idx_sound, self.inverted_tag_index[tag]] = 1
-                except KeyError:
-                    pass
-                    
+        weighting : None for the binary occurrences (in dtype),
+                    'tfidf' for tf-idf weights with l2 normalised rows (like TfidfVectorizer),
+                    'bm25' for Okapi BM25 weights (k1, b parameters), the weighted matrices are float32
+        """
+        index = self.inverted_tag_index
+        tags_idx = [[index[tag] for tag in tags if tag in index] for tags in self.sound_tags]
+        lengths = np.array([len(t) for t in tags_idx], dtype=np.int64)
+        cols = np.fromiter((i for t in tags_idx for i in t), dtype=np.int32, count=lengths.sum())
+        rows = np.repeat(np.arange(self.nb_sound, dtype=np.int32), lengths)
+        # duplicates are summed when converting to csr: data holds the term frequencies
+        matrix = scipy.sparse.coo_matrix((np.ones(len(cols), dtype=np.float32), (rows, cols)),
+                                         shape=(self.nb_sound, self.nb_tag)).tocsr()
+        if weighting is None:
+            matrix.data[:] = 1
+            matrix = matrix.astype(dtype)
+        elif weighting == 'tfidf':
+            df = np.bincount(matrix.indices, minlength=self.nb_tag)
+            idf = np.log((1. + self.nb_sound) / (1. + df)) + 1.
+            matrix.data *= idf[matrix.indices].astype(np.float32)
+            matrix = preprocessing.normalize(matrix, norm='l2', copy=False)
+        elif weighting == 'bm25':
+            df = np.bincount(matrix.indices, minlength=self.nb_tag)
+            idf = np.log(1. + (self.nb_sound - df + 0.5) / (df + 0.5))
+            doc_len = np.asarray(matrix.sum(axis=1)).ravel()
+            norm = k1 * (1 - b + b * doc_len / (doc_len.mean() if len(doc_len) else 1.))
+            norm = np.repeat(norm, np.diff(matrix.indptr))
+            tf = matrix.data
+            matrix.data = (idf[matrix.indices] * tf * (k1 + 1) / (tf + norm)).astype(np.float32)
+        else:
+            raise ValueError('unknown weighting %s' % weighting)
+        self.sound_tag_matrix = matrix
+        return matrix
                     
     def return_tag_cooccurrences_matrix(self):
         """
         Returns the tag to tag cooccurrences matrix by doing A_transpose * A where A is the sound to tag matrix occurrences
         """
         try:
-            return self.sound_tag_matrix.transpose() * self.sound_tag_matrix      
+            occurrences = self.sound_tag_matrix
+            if occurrences.dtype.itemsize < 4: # int8 or bool matrix, the products would overflow
+                occurrences = occurrences.astype(np.int32)
+            return occurrences.transpose() * occurrences
         except:
             print 'Create fist the sound tag matrix using create_sound_tag_matrix method'
             
     @staticmethod
-    def return_similarity_matrix_tags(tag_something_matrix):
+    def return_similarity_matrix_tags(tag_something_matrix, k=None, threshold=None, memory_budget=256, processes=1):
         """
         Returns a tag similarity matrix computed with cosine distance from the given matrix
-        MemoryError problem
+        Dense matrix (MemoryError problem for big matrices), unless k or threshold are given:
+        then only the k most similar and/or >= threshold are kept in a sparse matrix (see top_k_cosine_similarity)
         """
-        tag_similarity_matrix = cosine_similarity(tag_something_matrix)
-        return tag_similarity_matrix
+        if k is None and threshold is None:
+            return cosine_similarity(tag_something_matrix)
+        return top_k_cosine_similarity(tag_something_matrix, k=k, threshold=threshold,
+                                       memory_budget=memory_budget, processes=processes)
     
-    def return_my_similarity_matrix_tags(self, tag_something_matrix):
+    def return_my_similarity_matrix_tags(self, tag_something_matrix, k=100, threshold=None, memory_budget=256, processes=1):
         """
-        TOO SLOW !!!
-        Returns a tag similarity matrix computed with cosine distance from the given matrix
+        Returns a sparse tag similarity matrix computed with cosine distance from the given matrix,
+        without the similarity of a tag with itself, keeping the k most similar of each row and/or the ones >= threshold
+        (k=None and threshold=None keep all the non zero similarities, see top_k_cosine_similarity)
         """
-        size_matrix = tag_something_matrix.shape[0]
-        tag_similarity_matrix = np.zeros(shape=(size_matrix,size_matrix), dtype='float32')
-        Bar = ProgressBar(size_matrix*size_matrix/2, LENGTH_BAR, 'Calculating similarities...')
-        Bar.update(0)
-        for i0 in range(size_matrix):
-            row0 = tag_something_matrix.getrow(i0).toarray()
-            for i1 in range(i0):
-                Bar.update(i0*size_matrix + i1 + 1)
-                row1 = tag_something_matrix.getrow(i1).toarray()
-                tag_similarity_matrix[i0][i1] = 1 - spatial.distance.cosine(row0, row1)
-                tag_similarity_matrix[i1][i0] = tag_similarity_matrix[i0][i1]
-        return tag_similarity_matrix
+        return top_k_cosine_similarity(tag_something_matrix, k=k, threshold=threshold, exclude_self=True,
+                                       memory_budget=memory_budget, processes=processes)
     
     """
     PRINT SOME SIMILARITIES BTW TAGS:
@@ -1354,90 +3194,207 @@ class Nlp:
     
     @staticmethod
     def nearest_neighbors(similarity_matrix, idx, k):
-        distances = []
-        for x in range(len(similarity_matrix)):
-            distances.append((x,similarity_matrix[idx][x]))
-        distances.sort(key=operator.itemgetter(1), reverse=True)
-        return [d[0] for d in distances[0:k]]
+        """ Returns the indexes of the k most similar to idx, use knn_indices() for all the rows at once """
+        return knn_indices(similarity_matrix[idx:idx+1], k)[0][0].tolist()
     
     def knn(self, similarity_matrix, idx, k, freesound_ids):
-        distances = zip(freesound_ids, similarity_matrix[idx]) # zip together ids and similarity
-        distances.sort(key=operator.itemgetter(1), reverse=True)
-        return [d for d in distances[0:k]]
+        """ Returns the list of (freesound id, similarity) of the k most similar to idx """
+        indices, scores = knn_indices(similarity_matrix[idx:idx+1], k)
+        return [(freesound_ids[i], s) for i, s in zip(indices[0], scores[0])]
     
-    def compute_knn_similarities(self, feature_matrix):
+    def compute_knn_similarities(self, feature_matrix, k=10000, block_size=1000, processes=None,
+                                 path='knn_blocks', table=KNN_TABLE, db_name='freesound_similarities'):
         """ 
-        Created to compute all the 10000th most similar pairwise cosine similarity for FreesoundDB, text features
-        Takes to much memory. Store result in db during...
-        """
-        sql = SQLManager('freesound_similarities')
-        #dict_nn = {}
-        Bar = ProgressBar(feature_matrix.shape[0], LENGTH_BAR, 'Computing similarities')
+        Compute the k most similar sounds (cosine similarity) of all the sounds for FreesoundDB, text features,
+        and store them in the table (freesound_id, neighbours, scores) of the db, neighbours and scores being
+        the int32 freesound ids and float32 similarities arrays stored as bytea (see read_knn_table).
+        The blocks of block_size rows are computed in a pool of processes and saved in path/block_<start>.npz,
+        then copied into the db with COPY. Computed and copied blocks are skipped when it is run again with the
+        same features, ids, k and block_size (saved in path/manifest.json), otherwise the old blocks are removed.
+        """
+        ids = np.array(self.freesound_sound_id, dtype=np.int64)
+        self._check_knn_manifest(path, feature_matrix, ids, k, block_size)
+        starts = range(0, feature_matrix.shape[0], block_size)
+        todo = [start for start in starts if not os.path.exists(self._knn_block_path(path, start))]
+        Bar = ProgressBar(len(starts), LENGTH_BAR, 'Computing similarities')
+        Bar.update(len(starts) - len(todo))
+        if todo:
+            global _knn_operands
+            rows = preprocessing.normalize(as_features(feature_matrix, np.float32), norm='l2')
+            columns = rows.T.tocsc() if scipy.sparse.issparse(rows) else np.ascontiguousarray(rows.T)
+            _knn_operands = (rows, columns, ids, k, block_size, path)
+            pool = multiprocessing.Pool(processes or multiprocessing.cpu_count()) if processes != 1 and len(todo) > 1 else None
+            try:
+                results = pool.imap_unordered(_knn_block, todo) if pool is not None else (_knn_block(start) for start in todo)
+                for done, _ in enumerate(results):
+                    Bar.update(len(starts) - len(todo) + done + 1)
+            finally:
+                _knn_operands = None
+                if pool is not None:
+                    pool.terminate()
+        self.copy_knn_blocks(starts, path, table, db_name)
+
+    @staticmethod
+    def _knn_block_path(path, start):
+        return os.path.join(path, 'block_%d.npz' % start)
+
+    @staticmethod
+    def _check_knn_manifest(path, feature_matrix, ids, k, block_size):
+        """ Empty the blocks folder if its blocks were computed with other parameters, and write the manifest """
+        import hashlib
+        sha = hashlib.sha1()
+        sha.update(ids.tostring())
+        if scipy.sparse.issparse(feature_matrix):
+            feature_matrix = feature_matrix.tocsr()
+            for array in (feature_matrix.data, feature_matrix.indices, feature_matrix.indptr):
+                sha.update(np.ascontiguousarray(array).tostring())
+        else:
+            sha.update(np.ascontiguousarray(feature_matrix).tostring())
+        manifest = {'k': k, 'block_size': block_size, 'nb_rows': feature_matrix.shape[0],
+                    'shape': list(feature_matrix.shape), 'sha1': sha.hexdigest()}
+        manifest_path = os.path.join(path, 'manifest.json')
+        if os.path.exists(path):
+            old_manifest = None
+            if os.path.exists(manifest_path):
+                with open(manifest_path) as infile:
+                    old_manifest = json.load(infile)
+            if old_manifest != manifest:
+                if os.listdir(path):
+                    print 'The blocks in %s were computed with other parameters, they are removed' % path
+                shutil.rmtree(path)
+        if not os.path.exists(path):
+            os.makedirs(path)
+            with open(manifest_path, 'w') as outfile:
+                json.dump(manifest, outfile)
+
+    def copy_knn_blocks(self, starts, path='knn_blocks', table=KNN_TABLE, db_name='freesound_similarities'):
+        """
+        Copy the computed blocks (see compute_knn_similarities) into the table with COPY, one transaction per block.
+        A block is marked as copied with a path/block_<start>.copied file
+        """
+        from cStringIO import StringIO
+        sql = SQLManager(db_name)
+        sql.cur.execute('create table if not exists ' + table + ' (freesound_id integer primary key, neighbours bytea, scores bytea)')
+        sql.conn.commit()
+        Bar = ProgressBar(len(starts), LENGTH_BAR, 'Copying similarities')
         Bar.update(0)
-        bar_k = 0
-        for k in range(int(np.ceil(feature_matrix.shape[0]/1000.0))):
-            pairwise = cosine_similarity(feature_matrix[1000*k:1000*(k+1)], feature_matrix)
-            for idx in range(pairwise.shape[0]):
-                #dict_nn[self.freesound_sound_id[idx+k*1000]] = self.knn(pairwise,idx,10000)
-                sql.cur.execute('insert into nearest2(freesound_id, data) values(%s, %s)', (self.freesound_sound_id[idx+k*1000], json.dumps(self.knn(pairwise,idx,10000, self.freesound_sound_id))))
-                bar_k +=1
-                Bar.update(bar_k)
-            sql.conn.commit()
-        #return dict_nn
+        for i, start in enumerate(starts):
+            marker = os.path.join(path, 'block_%d.copied' % start)
+            if not os.path.exists(marker):
+                block = np.load(self._knn_block_path(path, start))
+                buf = StringIO()
+                for fs_id, neighbours, scores in zip(block['ids'], block['neighbours'], block['scores']):
+                    buf.write('%d\t\\\\x%s\t\\\\x%s\n' % (fs_id, neighbours.tostring().encode('hex'), scores.tostring().encode('hex')))
+                buf.seek(0)
+                sql.cur.execute('delete from ' + table + ' where freesound_id = any(%s)', (block['ids'].tolist(),)) # if copied before the marker
+                sql.cur.copy_from(buf, table, columns=('freesound_id', 'neighbours', 'scores'))
+                sql.conn.commit()
+                open(marker, 'w').close()
+            Bar.update(i + 1)
+        sql.disconnect()
+
+    @staticmethod
+    def read_knn_table(rows):
+        """
+        Returns the (freesound_id, neighbours ids array, scores array) of rows selected in a table
+        created by compute_knn_similarities
+        """
+        for fs_id, neighbours, scores in rows:
+            yield fs_id, np.frombuffer(neighbours, dtype=np.int32), np.frombuffer(scores, dtype=np.float32)
         
-    def create_graph_from_nearest(self):
-        k_nn = 100
-        sql = SQLManager('freesound_similarities')
+    @staticmethod
+    def iter_nearest(k_nn, threshold=None, table=KNN_TABLE, db_name='freesound_similarities', itersize=2000):
+        """
+        Yields (freesound_id, neighbour ids array, scores array) for all the sounds of a nearest neighbours table,
+        in freesound id order, keeping the k_nn first neighbours (with a score > threshold).
+        The table is scanned once with a server side cursor. The neighbours are truncated in SQL for the binary
+        tables of compute_knn_similarities, and while decoding the json for the old nearest2 table.
+        """
+        from cStringIO import StringIO
+        from itertools import islice
+        sql = SQLManager(db_name)
+        columns = [r[0] for r in sql.command('select column_name from information_schema.columns where table_name = %s', (table,))]
+        cur = sql.conn.cursor(name='iter_nearest') # server side cursor
+        cur.itersize = itersize
+        try:
+            if 'neighbours' in columns:
+                cur.execute('select freesound_id, substring(neighbours from 1 for %s), substring(scores from 1 for %s) from ' + table +
+                            ' order by freesound_id asc', (4 * k_nn, 4 * k_nn))
+                for fs_id, neighbours, scores in cur:
+                    neighbours = np.frombuffer(neighbours, dtype=np.int32)
+                    scores = np.frombuffer(scores, dtype=np.float32)
+                    if threshold is not None:
+                        neighbours, scores = neighbours[scores > threshold], scores[scores > threshold]
+                    yield fs_id, neighbours, scores
+            else:
+                cur.execute('select freesound_id, data::text from ' + table + ' order by freesound_id asc')
+                for fs_id, data in cur:
+                    pairs = ijson.items(StringIO(data), 'item')
+                    if threshold is not None:
+                        pairs = (p for p in pairs if p[1] > threshold)
+                    pairs = list(islice(pairs, k_nn)) # the json is not decoded after the k_nn first neighbours
+                    yield (fs_id, np.array([p[0] for p in pairs], dtype=np.int64),
+                           np.array([float(p[1]) for p in pairs], dtype=np.float32))
+        finally:
+            cur.close()
+            sql.disconnect()
+
+    def create_graph_from_nearest(self, k_nn=100, table=KNN_TABLE):
+        """ Returns the NetworkX knn graph of the nearest neighbours table """
         g = nx.Graph()
-        fs_ids = [r[0] for r in sql.command('select freesound_id from nearest2 order by freesound_id asc')]
-        nb_sound = len(fs_ids)
-        Bar = ProgressBar(nb_sound, LENGTH_BAR, 'Creating Graph')
-        Bar.update(0)
-        g.add_nodes_from(fs_ids)
-        for i, fs_id in enumerate(fs_ids):
-            Bar.update(i+1)
-            g.add_edges_from([(fs_id, r[0]) for r in sql.command('select data from nearest2 where freesound_id = %s', (str(fs_id),))[0][0]][:k_nn])
+        for fs_id, neighbours, _ in self.iter_nearest(k_nn, table=table):
+            g.add_node(fs_id)
+            g.add_edges_from((fs_id, int(n)) for n in neighbours)
         return g
 
-    def create_graph_text_file(self):
-        # pb with idx! gen_louvain needs idx in range
-        k_nn = 100
-        sql = SQLManager('freesound_similarities')
-        fs_ids = [r[0] for r in sql.command('select freesound_id from nearest2 order by freesound_id asc')]
-        nb_sound = len(fs_ids)
-        f = open('graph.txt', 'w')
-        Bar = ProgressBar(nb_sound, LENGTH_BAR, 'Generating text file')
-        Bar.update(0)
-        for i, fs_id in enumerate(fs_ids):
-            Bar.update(i+1)
-            list_edges = ''.join([str(str(fs_id) + ' ' + str(r[0]) + '\n') for r in sql.command('select data from nearest2 where freesound_id = %s', (str(fs_id),))[0][0]][:k_nn])
-            f.write(list_edges)
-        f.close()
+    def create_sparse_graph_from_nearest(self, k_nn=100, threshold=None, table=KNN_TABLE):
+        """
+        Returns the (nb sounds, nb sounds) scipy csr weighted adjacency matrix of the nearest neighbours table
+        and the sorted freesound ids of its rows (neighbours that are not in the table are skipped)
+        """
+        fs_ids, rows, cols, data = [], [], [], []
+        for fs_id, neighbours, scores in self.iter_nearest(k_nn, threshold, table=table):
+            rows.append(np.full(len(neighbours), len(fs_ids), dtype=np.int32))
+            fs_ids.append(fs_id)
+            cols.append(neighbours)
+            data.append(scores)
+        fs_ids = np.array(fs_ids, dtype=np.int64)
+        rows, cols, data = [np.concatenate(a) if a else np.zeros(0) for a in (rows, cols, data)]
+        idx = np.clip(np.searchsorted(fs_ids, cols), 0, max(len(fs_ids) - 1, 0))
+        known = fs_ids[idx] == cols if len(fs_ids) else np.zeros(0, dtype=bool)
+        matrix = scipy.sparse.csr_matrix((data[known].astype(np.float32), (rows[known], idx[known])), shape=(len(fs_ids), len(fs_ids)))
+        return matrix, fs_ids
+
+    def create_graph_text_file(self, k_nn=100, path='graph.txt', table=KNN_TABLE):
+        """ Write the edges 'freesound_id neighbour_id' of the nearest neighbours table in a text file """
+        # pb with idx! gen_louvain needs idx in range, see export_nearest_graph
+        with open(path, 'w', 2 ** 24) as f:
+            for fs_id, neighbours, _ in self.iter_nearest(k_nn, table=table):
+                np.savetxt(f, np.column_stack((np.repeat(fs_id, len(neighbours)), neighbours)), fmt='%d %d')
         
-    def create_weighted_graph_text_file(self):
-        threshold = 0.0
-        k_nn = 5000
-        sql = SQLManager('freesound_similarities')
-        fs_ids = [r[0] for r in sql.command('select freesound_id from nearest2 order by freesound_id asc')]
-        fs_id_to_id = {}
-        for idx,i in enumerate(fs_ids):
-            fs_id_to_id[i]=idx
-        nb_sound = len(fs_ids)
-        f = open('graph.txt', 'w')
-        Bar = ProgressBar(nb_sound, LENGTH_BAR, 'Generating text file')
-        Bar.update(0)
-        for i, fs_id in enumerate(fs_ids):
-            Bar.update(i+1)
-            list_edges = ''.join([str(str(fs_id_to_id[fs_id]) + ' ' + str(fs_id_to_id[r[0]]) + ' ' + str(r[1]) + '\n') for r in sql.command('select data from nearest2 where freesound_id = %s', (str(fs_id),))[0][0] if r[1]>threshold][:k_nn])
-            f.write(list_edges)
-        f.close() 
+    def create_weighted_graph_text_file(self, k_nn=5000, threshold=0.0, path='graph.txt', table=KNN_TABLE):
+        """
+        Write the weighted edges 'idx neighbour_idx score' of the nearest neighbours table in a text file,
+        idx being the rank of the freesound ids (see export_nearest_graph)
+        """
+        self.export_nearest_graph(path, k_nn, threshold, table, binary=False)
+
+    def export_nearest_graph(self, path='graph.bin', k_nn=100, threshold=None, table=KNN_TABLE, weighted=True, binary=True):
+        """
+        Export the knn graph of the nearest neighbours table for the C++ Louvain tools (see write_louvain_graph),
+        the freesound ids are remapped to contiguous indexes, the mapping is saved in path.ids.npy
+        >>> nlp.export_nearest_graph('graph.bin', k_nn=100)
+        $ ./louvain graph.bin -l -1 -w graph.bin.weights > graph.tree
+        """
+        adjacency, fs_ids = self.create_sparse_graph_from_nearest(k_nn, threshold, table)
+        write_louvain_graph(adjacency, path, fs_ids, weighted, binary)
         
     def return_lda_model(self, sound_tag_matrix, n_topics):
         lda = LatentDirichletAllocation(n_topics=n_topics, max_iter=5,
                                 learning_method='online',
                                 learning_offset=50.,
                                 random_state=0,
-                                n_jobs=1)
+                                n_jobs=-1)
         lda.fit(sound_tag_matrix)
         return lda
         #return lda.transform(sound_tag_matrix)
@@ -1459,9 +3416,8 @@ class Nlp:
         np.fill_diagonal(similarity_matrix, 0) # for removing the 1 from diagonal
         g = nx.Graph()
         g.add_nodes_from(range(len(similarity_matrix)))
-        for idx in range(len(similarity_matrix)):
-            g.add_edges_from([(idx, i) for i in self.nearest_neighbors(similarity_matrix, idx, k)])
-            print idx, self.nearest_neighbors(similarity_matrix, idx, k)
+        indices = knn_indices(similarity_matrix, k)[0]
+        g.add_edges_from((idx, int(i)) for idx in range(len(similarity_matrix)) for i in indices[idx])
         return g
     
     # OLD
@@ -1516,6 +3472,104 @@ class Nlp:
     
     
     
+#_________________________________________________________________#
+#                       Topic model class                         #
+#_________________________________________________________________#
+class TopicModel:
+    """
+    Online LDA topic model of the sound tags, trained with partial_fit on chunks of chunk_size sounds
+    (read from the store for baskets opened with Client.open_basket_store) or of rows of a sparse sound/tag matrix,
+    so that the whole matrix is never in memory. The model can be saved and updated later with new sounds.
+    The tags vocabulary is fixed at creation, other tags are ignored.
+    n_jobs: number of cores used for the E-step of each chunk, all of them by default
+    >>> tm = TopicModel([t[0] for t in b.tags_occurrences()], n_topics=200)
+    >>> tm.partial_fit(b)
+    >>> tm.save('lda200.pkl')
+    >>> tm = TopicModel.load('lda200.pkl')
+    >>> tm.partial_fit(new_basket)
+    >>> tm.update_topic_features(new_basket, 'text_features_FS_lda200_allTags.pkl')
+    """
+    def __init__(self, tags, n_topics=50, chunk_size=10000, batch_size=1000, total_samples=None, n_jobs=-1):
+        self.tags = list(tags)
+        self.tag_index = {tag: idx for idx, tag in enumerate(self.tags)}
+        self.chunk_size = chunk_size
+        self.nb_sounds_seen = 0
+        self.lda = LatentDirichletAllocation(n_topics=n_topics,
+                                             learning_method='online',
+                                             learning_offset=50.,
+                                             batch_size=batch_size,
+                                             total_samples=total_samples or 1e6,
+                                             random_state=0,
+                                             n_jobs=n_jobs)
+        self._total_samples_set = total_samples is not None
+
+    def tag_matrix(self, sounds):
+        """ Returns the binary csr sound/tag matrix of a list of sounds (see Nlp.create_sound_tag_matrix) """
+        index = self.tag_index
+        tags_idx = [list(set(index[tag] for tag in sound.tags if tag in index)) if sound is not None else []
+                    for sound in sounds]
+        lengths = np.array([len(t) for t in tags_idx], dtype=np.int64)
+        cols = np.fromiter((i for t in tags_idx for i in t), dtype=np.int32, count=lengths.sum())
+        rows = np.repeat(np.arange(len(sounds), dtype=np.int32), lengths)
+        return scipy.sparse.csr_matrix((np.ones(len(cols), dtype=np.float32), (rows, cols)),
+                                       shape=(len(sounds), len(self.tags)))
+
+    def iter_matrices(self, data):
+        """ Yields (ids, sound/tag matrix) chunks of a Basket or of a sparse matrix (ids are then None) """
+        if scipy.sparse.issparse(data):
+            data = data.tocsr()
+            for start in range(0, data.shape[0], self.chunk_size):
+                yield None, data[start:start+self.chunk_size]
+        else:
+            for chunk in data.iter_chunks(self.chunk_size, columns=['ids', 'tags']):
+                yield chunk.ids, self.tag_matrix(chunk.sounds)
+
+    def partial_fit(self, data, passes=1):
+        """ Update the model with the sounds of a Basket or the rows of a sparse sound/tag matrix """
+        nb_sounds = data.shape[0] if scipy.sparse.issparse(data) else len(data)
+        if not self._total_samples_set: # estimated size of the whole collection, used to scale the updates
+            self.lda.total_samples = max(nb_sounds, 1)
+            self._total_samples_set = True
+        nb_chunks = passes * int(np.ceil(nb_sounds / float(self.chunk_size)))
+        Bar = ProgressBar(nb_chunks, LENGTH_BAR, 'Training LDA')
+        Bar.update(0)
+        done = 0
+        for _ in range(passes):
+            for _, matrix in self.iter_matrices(data):
+                if matrix.shape[0]:
+                    self.lda.partial_fit(matrix)
+                    self.nb_sounds_seen += matrix.shape[0]
+                done += 1
+                Bar.update(done)
+        return self
+
+    def transform(self, data):
+        """ Returns the (nb sounds, n_topics) float32 topic vectors of a Basket or of the rows of a sparse matrix """
+        vectors = [self.lda.transform(matrix).astype(np.float32) for _, matrix in self.iter_matrices(data) if matrix.shape[0]]
+        return np.vstack(vectors) if vectors else np.zeros((0, self.lda.n_topics), dtype=np.float32)
+
+    def update_topic_features(self, basket, path):
+        """
+        Add the topic vectors of the sounds of the basket to the pickled text features {'freesound id': vector}
+        (see knn_graph_clustering.py), creating the file if needed
+        """
+        features = Client.load_pickle(path) if os.path.exists(path) else {}
+        for ids, matrix in self.iter_matrices(basket):
+            if matrix.shape[0]:
+                features.update(zip((str(i) for i in ids), self.lda.transform(matrix).astype(np.float32)))
+        Client.save_pickle(features, path + '.tmp')
+        os.rename(path + '.tmp', path)
+        return features
+
+    def save(self, path):
+        Client.save_pickle(self, path + '.tmp')
+        os.rename(path + '.tmp', path)
+
+    @staticmethod
+    def load(path):
+        return Client.load_pickle(path)
+
+
 # _________________________________________________________________#
 #                           SQL class                              #
 # _________________________________________________________________#
@@ -1807,11 +3861,27 @@ class GraylogManager:
 #_________________________________________________________________#
 #                             UTILS                               #
 #_________________________________________________________________#
+_analysis_template = None
+
+def analysis_template():
+    """
+    Returns the dict of analysis_template.json (next to manager.py, or in the working directory),
+    parsed once per process. Do not modify it, copy it before (see DictObject)
+    """
+    global _analysis_template
+    if _analysis_template is None:
+        _analysis_template = {}
+        for path in (ANALYSIS_TEMPLATE, 'analysis_template.json'):
+            if os.path.exists(path):
+                with open(path) as infile:
+                    _analysis_template = simplejson.load(infile)
+                break
+    return _analysis_template
+
 class DictObject:
     def __init__(self, json_dict=None):
         if not json_dict:
-            with open('analysis_template.json') as infile:
-                json_dict = simplejson.load(infile)
+            json_dict = copy.deepcopy(analysis_template())
 
         self.json_dict = json_dict
 
@@ -1828,6 +3898,83 @@ class DictObject:
             if isinstance(v, dict):
                 self.__dict__[k] = DictObject(v)
 
+def as_features(features, dtype=None):
+    """
+    Returns the features (list, array or scipy sparse matrix) as an array of the settings.features_dtype (or dtype),
+    use it before computing similarities so that they are not done in float64
+    """
+    dtype = dtype or SettingsSingleton().features_dtype
+    if scipy.sparse.issparse(features):
+        return features.astype(dtype)
+    return np.asarray(features, dtype=dtype)
+
+def check_precision(features, dtype=None, nb_rows=1000):
+    """
+    Check the error introduced by storing features (or frames values) in a reduced precision dtype
+    (settings.features_dtype by default) compared to float64.
+    Returns the max absolute and relative errors of the values and the max absolute error of the cosine similarities
+    computed between the first nb_rows rows.
+    >>> check_precision(b.extract_descriptor_stats(scale=True, dtype='float64'), 'float16')
+    {'max_abs_error': ..., 'max_rel_error': ..., 'max_similarity_error': ...}
+    """
+    reference = np.asarray(features, dtype=np.float64)
+    if reference.ndim == 1:
+        reference = reference[:, None]
+    reference = reference[~np.isnan(reference).any(axis=1)]
+    reduced = as_features(reference, dtype).astype(np.float64)
+    errors = np.abs(reduced - reference)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        rel_errors = errors / np.abs(reference)
+    rel_errors[reference == 0] = errors[reference == 0]
+    sample = slice(0, nb_rows)
+    similarity_error = np.abs(cosine_similarity(reduced[sample]) - cosine_similarity(reference[sample])) if len(reference) else np.zeros(0)
+    return {'max_abs_error': float(errors.max()) if errors.size else 0.,
+            'max_rel_error': float(np.nanmax(rel_errors)) if rel_errors.size else 0.,
+            'max_similarity_error': float(similarity_error.max()) if similarity_error.size else 0.}
+
+def _parse_frames_files(task):
+    """
+    Pool worker of Client.my_get_analysis_parallel(): parse the frames of a descriptor in the analysis json files
+    of some sounds and save them concatenated in out_path.
+    Returns the number of frames of each sound (-1 if the sound has no such analysis), the frames ndim
+    (0 for descriptors with a single value, None if no sound has the analysis) and out_path
+    """
+    ids, descriptor, dtype, out_path = task
+    frames = []
+    lengths = []
+    ndim = None
+    for idToLoad in ids:
+        with open('analysis/' + str(idToLoad) + '.json') as infile:
+            analysis = simplejson.load(infile)
+        for key in descriptor.split('.'):
+            analysis = analysis.get(key) if isinstance(analysis, dict) else None
+        if analysis is None:
+            lengths.append(-1)
+            continue
+        f = np.asarray(analysis, dtype=dtype)
+        ndim = f.ndim if ndim is None else max(ndim, f.ndim)
+        frames.append(f.reshape(f.shape[0], int(np.prod(f.shape[1:]))) if f.ndim else f.reshape(1, 1))
+        lengths.append(len(frames[-1]))
+    widths = set(f.shape[1] for f in frames if len(f))
+    width = widths.pop() if len(widths) == 1 else 1
+    frames = [f for f in frames if len(f)]
+    np.save(out_path, np.concatenate(frames).reshape(-1, width) if frames else np.zeros((0, width), dtype=dtype))
+    return lengths, ndim, out_path
+
+def _preprocess_chunk(task):
+    """ Pool worker of TextPreprocessor.map() """
+    method, items = task
+    function = getattr(TextPreprocessor.shared(), method)
+    return [function(*item) for item in items]
+
+def _parse_stats_files(ids):
+    """ Pool worker of Client.my_get_analysis_stats_parallel(): returns the dicts of the analysis stats json files """
+    all_stats = []
+    for idToLoad in ids:
+        with open('analysis_stats/' + str(idToLoad) + '.json') as infile:
+            all_stats.append(simplejson.load(infile))
+    return all_stats
+
 def flat_list(l):
     """ Convert a nested list to a flat list """
     try:
@@ -7,7 +7,7 @@ import numpy as np
 
 c  = manager.Client(False)
 b = c.load_basket_pickle('FreesoundDb') 
-r = b.preprocessing_tag_description()
+r = b.preprocessing_tag_description(cache=True)
 #r = b.preprocessing_doc2vec()
 
 # load tags occurrences to know which are the tags most used
@@ -31,20 +31,9 @@ def run_doc2vec(b, r, size_space):
     return model
 
 def create_doc_vec(model, r):
-    import numpy as np
-    docs = []
-    for d in r:
-        v = np.zeros(model.vector_size)
-        count = 0
-        for w in d:
-            try:
-                v +=  model[w]
-                count += 1
-            except KeyError:
-                pass
-        v = v / count
-        docs.append(v)
-    return docs
+    import manager
+    t = manager.Basket.TfidfEmbeddingVectorizer(model)
+    return list(t.transform(r, weighted=False)) # mean of the word vectors of each document
 
 def create_doc_vec_with_tfidf(b, model, r):
     t = b.TfidfEmbeddingVectorizer(model)
@@ -23,9 +23,9 @@ b_UrbanSound8K = c.load_basket_pickle('UrbanSound8K') # This basket has been act
 b_FreesoundDb = c.load_basket_pickle('freesoundDb') # FreesoundDb exist only on devaraya node. In local use freesoundDb (from april 2016)
 
 # preprocess text data and getting class
-X = np.array(b_UrbanSound8K.preprocessing_tag_description())
+X = np.array(b_UrbanSound8K.preprocessing_tag_description(cache=True))
 y = np.array(b_UrbanSound8K.clas)
-X_FreesoundDb = np.array(b_FreesoundDb.preprocessing_tag_description())
+X_FreesoundDb = np.array(b_FreesoundDb.preprocessing_tag_description(cache=True))
 
 # class and methods for embedding sounds with w2v (cf: https://github.com/nadbordrozd/blog_stuff/blob/master/classification_w2v/benchmarking.ipynb)
 class MeanEmbeddingVectorizer(object):
@@ -2,20 +2,6 @@ import manager
 import sys
 from sklearn import cluster
 import webbrowser
-import functools
-
-def rsetattr(obj, attr, val):
-    pre, _, post = attr.rpartition('.')
-    return setattr(rgetattr(obj, pre) if pre else obj, post, val)
-
-sentinel = object()
-def rgetattr(obj, attr, default=sentinel):
-    if default is sentinel:
-        _getattr = getattr
-    else:
-        def _getattr(obj, name):
-            return getattr(obj, name, default)
-    return functools.reduce(_getattr, [obj]+attr.split('.'))
 
 
 class SplitSearch():
@@ -39,7 +25,6 @@ class SplitSearch():
         self.sound_ids_to_remove = []
         for idx, item in enumerate(self.b.analysis_stats):
             if item:
-                self.descriptor.append(rgetattr(item, self.descriptor_name))
                 self.sound_ids.append(self.b.sounds[idx].id)
             else:
                 self.sound_ids_no_stats.append(self.b.sounds[idx].id)
@@ -49,9 +34,8 @@ class SplitSearch():
         self.b_refined = self.b
         self.b_refined.remove(self.sound_ids_to_remove)
 
-        # Ensure that the dimension of the descriptor is NxK with N:nb data, K=dim
-        if not isinstance(self.descriptor[0], list):
-            self.descriptor = [[i] for i in self.descriptor]
+        # NxK matrix with N:nb data, K=dim of all the descriptors
+        self.descriptor = self.b_refined.select_descriptors(self.descriptor_name.split(','))
                 
     def get_descriptors(self, scale=False):
         self.descriptor = []
@@ -0,0 +1,194 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+import simplejson
+
+import manager
+
+
+class FakeSound(object):
+    def __init__(self, id):
+        self.id = id
+        self.tags = ['wind']
+        self.description = u'wind blowing'
+
+
+class FakeClient(object):
+    """ Client returning fake sounds and frames, without requesting Freesound """
+    def my_get_sound(self, id):
+        return FakeSound(id)
+
+    def my_get_analysis_parallel(self, ids, descriptor, Bar=None):
+        return manager.RaggedFrames.from_list([np.ones((3, 2), dtype=np.float32) * i for i in ids])
+
+
+class TestRaggedFrames(unittest.TestCase):
+    def setUp(self):
+        self.frames = manager.RaggedFrames.from_list([np.ones((2, 3)), None, np.zeros((0, 3)), np.arange(9.).reshape(3, 3)])
+
+    def test_from_list(self):
+        frames = self.frames
+        self.assertEqual(len(frames), 4)
+        self.assertEqual(frames.values.shape, (5, 3))
+        np.testing.assert_array_equal(frames.offsets, [0, 2, 2, 2, 5])
+        np.testing.assert_array_equal(frames.mask, [True, False, True, True])
+        self.assertIsNone(frames[1])
+        self.assertEqual(frames[2].shape, (0, 3))
+        np.testing.assert_array_equal(frames[3], np.arange(9.).reshape(3, 3))
+
+    def test_from_list_1d_and_scalars(self):
+        frames = manager.RaggedFrames.from_list([[1., 2.], None, []])
+        np.testing.assert_array_equal(frames[0], [1, 2])
+        self.assertEqual(frames[2].shape, (0,))
+        scalars = manager.RaggedFrames.from_list([3., None, 4.])
+        self.assertEqual(np.ndim(scalars[0]), 0)
+        self.assertEqual(scalars[2], 4.)
+        self.assertIsNone(scalars[1])
+
+    def test_extend_empty_batches(self):
+        frames = self.frames
+        frames.extend([])
+        frames.extend([None, None])
+        frames.extend(manager.RaggedFrames.from_list([]))
+        self.assertEqual(len(frames), 6)
+        self.assertEqual(frames.values.shape, (5, 3))
+        np.testing.assert_array_equal(frames.offsets, [0, 2, 2, 2, 5, 5, 5])
+        frames.extend([np.ones((1, 3))])
+        np.testing.assert_array_equal(frames[6], np.ones((1, 3)))
+        self.assertRaises(ValueError, frames.extend, [np.ones((1, 2))])
+
+    def test_extend_empty_frames(self):
+        frames = manager.RaggedFrames.from_list([None])
+        frames.extend([np.ones((2, 3))])
+        self.assertEqual(frames.values.shape, (2, 3))
+        self.assertEqual(frames[1].shape, (2, 3))
+
+    def test_take_delete(self):
+        taken = self.frames.take([3, 1, 0])
+        np.testing.assert_array_equal(taken.offsets, [0, 3, 3, 5])
+        np.testing.assert_array_equal(taken[0], self.frames[3])
+        self.assertIsNone(taken[1])
+        self.frames.delete([0, 2])
+        np.testing.assert_array_equal(self.frames.offsets, [0, 0, 3])
+        np.testing.assert_array_equal(self.frames[1], np.arange(9.).reshape(3, 3))
+        self.assertIsNone(self.frames[0])
+
+    def test_reductions_empty_segments(self):
+        stats = self.frames.stats()
+        for name in ('mean', 'var', 'min', 'max'):
+            self.assertEqual(stats[name].shape, (4, 3))
+            self.assertTrue(np.isnan(stats[name][1:3]).all())
+        np.testing.assert_array_equal(stats['mean'][0], [1, 1, 1])
+        np.testing.assert_allclose(stats['mean'][3], [3, 4, 5])
+        np.testing.assert_allclose(stats['var'][3], [6, 6, 6])
+        np.testing.assert_array_equal(stats['min'][3], [0, 1, 2])
+        np.testing.assert_array_equal(stats['max'][3], [6, 7, 8])
+        np.testing.assert_array_equal(stats['dmean'][3], [3, 3, 3])
+
+
+class TestFramesToStats(unittest.TestCase):
+    def test_only_framewise_aggregated(self):
+        frames = {'lowlevel': {'mfcc': [[1, 2], [3, 4]], 'average_loudness': 0.5},
+                  'rhythm': {'beats_position': [0.1, 0.5, 0.9], 'beats_loudness': [1, 3]},
+                  'tonal': {'chords_histogram': [1, 2, 3], 'key_key': 'A'}}
+        stats = manager.Client._frames_to_stats([frames, None])
+        self.assertEqual(stats[1], {})
+        stats = stats[0]
+        self.assertEqual(stats['lowlevel']['mfcc']['mean'], [2, 3])
+        self.assertEqual(stats['lowlevel']['average_loudness'], 0.5)
+        self.assertEqual(stats['rhythm']['beats_loudness']['mean'], 2)
+        self.assertEqual(stats['rhythm']['beats_position'], [0.1, 0.5, 0.9])
+        self.assertEqual(stats['tonal']['chords_histogram'], [1, 2, 3])
+        self.assertEqual(stats['tonal']['key_key'], 'A')
+
+
+class TestBasketLoad(unittest.TestCase):
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.tmp_path = tempfile.mkdtemp()
+        os.chdir(self.tmp_path)
+        os.makedirs('baskets')
+        with open('baskets/test_load.json', 'w') as outfile:
+            simplejson.dump([[1, 2], ['lowlevel.spectral_complexity']], outfile)
+        manager.SettingsSingleton().local_baskets.append('test_load')
+
+    def tearDown(self):
+        manager.SettingsSingleton().local_baskets.remove('test_load')
+        os.chdir(self.cwd)
+        shutil.rmtree(self.tmp_path)
+
+    def test_load_keeps_frames(self):
+        b = manager.Basket(FakeClient())
+        b.load('test_load')
+        frames = b.analysis.lowlevel.spectral_complexity
+        self.assertIsInstance(frames, manager.RaggedFrames)
+        self.assertEqual(len(frames), 2)
+        np.testing.assert_array_equal(frames[1], np.ones((3, 2)) * 2)
+
+    def test_update_analysis_nothing_to_load(self):
+        b = manager.Basket(FakeClient())
+        b.load('test_load')
+        b.update_analysis()
+        self.assertEqual(len(b.analysis.lowlevel.spectral_complexity), 2)
+
+
+class TestBasketStore(unittest.TestCase):
+    def setUp(self):
+        self.tmp_path = tempfile.mkdtemp()
+        self.client = FakeClient()
+        b = manager.Basket(self.client)
+        b.ids = range(1, 6)
+        b.sounds = [manager.freesound.Sound({'id': i, 'name': u'sound %d' % i, 'username': 'user', 'description': u'wind \xe9',
+                                             'duration': i / 2., 'tags': ['wind', 'tag%d' % i]}, self.client) for i in b.ids]
+        b.analysis_stats = [manager.freesound.FreesoundObject({'lowlevel': {'average_loudness': i / 10.}}, self.client) for i in b.ids[:4]] + [None]
+        b.analysis.rsetattr('lowlevel.mfcc', manager.RaggedFrames.from_list([np.ones((i, 2)) * i if i != 3 else None for i in b.ids]))
+        b.analysis_names = ['lowlevel.mfcc']
+        self.basket = b
+        self.store = manager.BasketStore(os.path.join(self.tmp_path, 'store'))
+        self.store.write(b)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_path)
+
+    def test_round_trip(self):
+        b = self.store.read(self.client)
+        self.assertEqual(len(self.store), 5)
+        self.assertEqual(b.ids, [1, 2, 3, 4, 5])
+        self.assertEqual([s.name for s in b.sounds], [u'sound %d' % i for i in range(1, 6)])
+        self.assertEqual(b.sounds[0].description, u'wind \xe9')
+        self.assertEqual(b.sounds[1].tags, ['wind', 'tag2'])
+        self.assertEqual(b.sounds[4].duration, 2.5)
+        self.assertEqual(b.analysis_stats[1].lowlevel.average_loudness, 0.2)
+        self.assertIsNone(b.analysis_stats[4])
+        self.assertEqual(b.analysis_names, ['lowlevel.mfcc'])
+        frames = b.analysis.lowlevel.mfcc
+        np.testing.assert_array_equal(frames[1], np.ones((2, 2)) * 2)
+        self.assertIsNone(frames[2])
+        np.testing.assert_array_equal(frames[4], np.ones((5, 2)) * 5)
+
+    def test_read_columns(self):
+        b = self.store.read(self.client, columns=['ids', 'tags'], start=1, stop=3)
+        self.assertEqual(b.ids, [2, 3])
+        self.assertEqual([s.tags for s in b.sounds], [['wind', 'tag2'], ['wind', 'tag3']])
+        self.assertEqual(b.analysis_stats, [None, None])
+        self.assertEqual(b.analysis_names, [])
+
+    def test_iter_chunks(self):
+        chunks = list(self.store.iter_chunks(self.client, 2, columns=['ids', 'frames']))
+        self.assertEqual([c.ids for c in chunks], [[1, 2], [3, 4], [5]])
+        self.assertIsNone(chunks[1].analysis.lowlevel.mfcc[0])
+        np.testing.assert_array_equal(chunks[1].analysis.lowlevel.mfcc[1], np.ones((4, 2)) * 4)
+        np.testing.assert_array_equal(chunks[2].analysis.lowlevel.mfcc[0], np.ones((5, 2)) * 5)
+        self.assertEqual([c.ids for c in self.store.iter_chunks(self.client, 5, columns=['ids'])], [[1, 2, 3, 4, 5]])
+
+    def test_basket_iter_chunks(self):
+        b = self.store.open(self.client)
+        self.assertEqual([c.ids for c in b.iter_chunks(3, columns=['ids'])], [[1, 2, 3], [4, 5]])
+        self.assertEqual([c.ids for c in self.basket.iter_chunks(3)], [[1, 2, 3], [4, 5]])
+
+
+if __name__ == '__main__':
+    unittest.main()